@@ -38,6 +38,7 @@ from aiogram.filters import Command
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, \
     InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
 from dotenv import load_dotenv
+from outbound import OutboundLimiter
 from parser import get_flowers, cats_url
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
@@ -67,6 +68,8 @@ yes_no = InlineKeyboardMarkup(inline_keyboard=[[yes, no]])
 API_TOKEN_muziatikBot = os.getenv('API_TOKEN_muziatikBot')
 MY_CHAT_ID = os.getenv('MY_CHAT_ID')
 bot = Bot(API_TOKEN_muziatikBot)
+# go_house edits its countdown twice a second; the limiter paces those calls and retries on 429
+bot.session.middleware(OutboundLimiter())
 dp = Dispatcher()
 
 # bot.send_message(os.getenv('MY_CHAT_ID'),
@@ -0,0 +1,157 @@
+"""Buffered audit log used by db.log_event().
+
+Events are put on a queue and written by a background thread in batches
+(AUDIT_BATCH events or every AUDIT_FLUSH_INTERVAL seconds, whichever comes
+first) to a file that stays open. The file is rotated once it grows past
+AUDIT_MAX_BYTES. Several processes (supervisor workers) may append to the
+same file: before each batch the writer reopens the path if another
+process has rotated it away. Each line is one JSON object:
+
+    {"ts": "2025-01-01T12:00:00", "event": "FIELD_UPDATE", "user_id": 1, "field": "name", "value": "Dima"}
+
+Pending events are flushed at interpreter exit.
+"""
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+LOG_PATH = os.getenv('AUDIT_LOG_PATH', 'memory_log.txt')
+BATCH = int(os.getenv('AUDIT_BATCH', '100'))
+FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1'))
+MAX_BYTES = int(os.getenv('AUDIT_MAX_BYTES', str(10 * 1024 * 1024)))
+BACKUPS = int(os.getenv('AUDIT_BACKUPS', '5'))
+# Also print every event to stdout, like the old log_event did
+ECHO = os.getenv('AUDIT_ECHO', '') not in ('', '0', 'false', 'False')
+
+_STOP = object()
+
+
+class AuditLog:
+    def __init__(self, path=LOG_PATH, batch=BATCH, flush_interval=FLUSH_INTERVAL,
+                 max_bytes=MAX_BYTES, backups=BACKUPS):
+        self.path = path
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self.stats = {'events': 0, 'batches': 0, 'rotations': 0, 'errors': 0}
+
+    def log(self, event: str, **fields) -> None:
+        record = {'ts': datetime.datetime.now().isoformat(timespec='seconds'), 'event': event, **fields}
+        self._start()
+        with self._flushed:
+            self._pending += 1
+        self._queue.put(record)
+
+    def flush(self, timeout: float = 5) -> None:
+        """Block until everything logged so far is on disk."""
+        with self._flushed:
+            self._flushed.wait_for(lambda: self._pending == 0 or not self._alive(), timeout)
+
+    def close(self) -> None:
+        if self._alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        self._thread = None
+
+    # ---- writer thread ----
+
+    def _alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            batch = [first]
+            # Collect more events until the batch is full or the interval is up
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write(batch)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            line = json.dumps(record, ensure_ascii=False, default=str)
+            lines.append(line)
+            if ECHO:
+                print(line)
+        try:
+            if self._file is not None and self._moved():
+                self._file.close()
+                self._file = None
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write('\n'.join(lines) + '\n')
+            self._file.flush()
+            # The size of the shared file, not just what this process wrote
+            if os.fstat(self._file.fileno()).st_size >= self.max_bytes and not self._moved():
+                self._rotate()
+            self.stats['batches'] += 1
+            self.stats['events'] += len(batch)
+        except OSError as e:
+            self.stats['errors'] += 1
+            print(f'audit log write failed: {e}')
+        finally:
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+
+    def _moved(self):
+        # Another process rotated (renamed or deleted) the file we have open
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self._file.fileno())
+        return (current.st_ino, current.st_dev) != (opened.st_ino, opened.st_dev)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            src = f'{self.path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        self.stats['rotations'] += 1
+
+
+audit = AuditLog()
+atexit.register(audit.close)
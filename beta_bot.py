@@ -8,16 +8,34 @@ from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMar
     InlineQueryResultArticle, LabeledPrice, Message, CallbackQuery, InlineQuery, PreCheckoutQuery, \
     InputTextMessageContent
 from dotenv import load_dotenv
-from pydub import AudioSegment
 
-from db import remember, recall, forget, forget_name, create_feedback, get_feedback
+from conversation_state import get_state, set_state, pop_state, SEARCH
+from db_async import remember, recall, forget, forget_name, create_feedback, get_feedback, \
+    reserve_voice_slot, release_voice_slot, recall_page, forget_ids, search_memory, PAGE_SIZE
+import speech_engines
+import transcript_cache
+import transcription_pool
+import voice_pipeline
 
 
-def _transcribe_wav(path: str, language: str = 'ru-RU') -> str:
-    r = sr.Recognizer()
-    with sr.AudioFile(path) as source:
-        audio_data = r.record(source)
-    return r.recognize_google(audio_data, language=language)
+def _transcribe(audio_data: sr.AudioData, language: str = 'ru-RU') -> tuple:
+    # Движок выбирается через SPEECH_ENGINE (google, vosk, whisper, stub); возвращает (текст, движок)
+    return speech_engines.recognize(audio_data, language)
+
+
+# Лимит Telegram на текст сообщения — 4096 символов
+MESSAGE_LIMIT = 4000
+
+
+def _tail(text: str) -> str:
+    # Промежуточный результат: только хвост, чтобы правка влезла в одно сообщение
+    return text if len(text) <= MESSAGE_LIMIT - 100 else '…' + text[-(MESSAGE_LIMIT - 100):]
+
+
+async def _reply_text(message: Message, text: str) -> None:
+    # Расшифровка длинного голосового может не влезть в одно сообщение
+    for start in range(0, len(text), MESSAGE_LIMIT):
+        await message.reply(text[start:start + MESSAGE_LIMIT])
 
 
 def switch_layout(text: str) -> str:
@@ -36,6 +54,27 @@ def switch_layout(text: str) -> str:
     return "".join(full_map.get(char, char) for char in text)
 
 
+# Номера записей — BIGINT, больше не бывает
+MAX_ID = 2 ** 63 - 1
+
+
+def parse_ids(text: str, max_ids: int = 1000):
+    """Разбирает "1, 5, 7" и диапазоны "3-6" в список номеров; None, если это не номера."""
+    ids = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        start, sep, end = part.partition('-')
+        # isdecimal, а не isdigit: '²' — цифра, но int('²') падает
+        if not start.isdecimal() or (sep and not end.isdecimal()):
+            return None
+        start, end = int(start), int(end) if sep else int(start)
+        if end < start or end > MAX_ID or len(ids) + end - start + 1 > max_ids:
+            return None
+        ids.extend(range(start, end + 1))
+    return ids or None
+
+
 load_dotenv()
 
 # ======== Keyboards ========
@@ -55,6 +94,7 @@ menu_keyboard = InlineKeyboardMarkup(inline_keyboard=[
 memory_keyboard = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text='Запомнить', callback_data='remember')],
     [InlineKeyboardButton(text='Вспомнить', callback_data='recall')],
+    [InlineKeyboardButton(text='Найти', callback_data='search')],
     [InlineKeyboardButton(text='Забыть', callback_data='forget')]
 ])
 dev_keyboard = ReplyKeyboardMarkup(keyboard=[
@@ -83,7 +123,14 @@ try:
 except TypeError as e:
     print(f'Ключа та нет... :\n{e}')
 
-keyboard_input = {}
+VOICE_LANGUAGE = 'ru-RU'
+# Ключ кэша расшифровок: у разных движков разный текст. Ищем под основным движком,
+# сохраняем под тем, который на самом деле расшифровал (при откате это SPEECH_FALLBACK)
+CACHE_LANGUAGE = speech_engines.cache_key(VOICE_LANGUAGE)
+BUSY_TEXT = 'Сейчас слишком много голосовых на расшифровке, попробуйте через пару минут🙏'
+
+# Длинные записи обрезаются, чтобы страница влезла в лимит Telegram (4096 символов)
+MEMORY_ENTRY_PREVIEW = 350
 
 
 # ======== Helper ========
@@ -95,11 +142,48 @@ async def send_typing_indicator(chat_id, bot: Bot, wait=1, action='typing'):
     await bot.delete_message(chat_id, dots.message_id)
 
 
+async def render_memory_page(user_id: int, after_id: int = None, before_id: int = None):
+    """Текст и кнопки одной страницы памяти."""
+    rows, has_prev, has_next = await recall_page(user_id, after_id=after_id, before_id=before_id)
+    if not rows:
+        return 'Нет элементов в памяти😔', None
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'mem_page:prev:{rows[0][0]}'))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text='Дальше ➡️', callback_data=f'mem_page:next:{rows[-1][0]}'))
+    return _memory_lines(rows), InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+async def render_search_page(user_id: int, query: str, offset: int = 0):
+    """Текст и кнопки одной страницы результатов поиска по памяти."""
+    if not query.strip():
+        return 'Ничего не нашёл😔', None
+    rows, has_next = await search_memory(user_id, query, offset=offset)
+    if not rows:
+        return 'Ничего не нашёл😔', None
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'mem_search:{max(offset - PAGE_SIZE, 0)}'))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text='Дальше ➡️', callback_data=f'mem_search:{offset + len(rows)}'))
+    return _memory_lines(rows), InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+def _memory_lines(rows) -> str:
+    lines = []
+    for data_id, data in rows:
+        if len(data) > MEMORY_ENTRY_PREVIEW:
+            data = data[:MEMORY_ENTRY_PREVIEW] + '…'
+        lines.append(f'{data_id}: {data}')
+    return '\n'.join(lines)
+
+
 async def start_bot(message: Message):
     await send_typing_indicator(message.chat.id, message.bot)
     await message.answer("Здравствуйте, я **MuziatikBot**.", parse_mode="Markdown")
     await asyncio.sleep(1)
-    if name := await asyncio.to_thread(recall, message.from_user.id, "name"):
+    if name := await recall(message.from_user.id, "name"):
         name = name if name != ["Нет элементов в памяти😔"] else None
     if not name:
         await message.answer('Давайте познакомимся! Нажмите "Выбрать имя"')
@@ -117,8 +201,8 @@ async def info(message: Message):
     await message.reply_sticker('CAACAgIAAxkBAAEz-itoBW_hmrk-'
                                 '933qZ43mWlN1MK_QjAACsQ8AAldGSEutS54Fv2EAAe42BA', reply_markup=keyboard)
     await asyncio.sleep(2)
-    # Prefetch the user's name off the event loop, with a fallback
-    if name := await asyncio.to_thread(recall, message.from_user.id, "name"):
+    # Prefetch the user's name without blocking the loop, with a fallback
+    if name := await recall(message.from_user.id, "name"):
         name = name if name != ["Нет элементов в памяти😔"] else "гость"
     await message.reply(
         f"Вот информация о MuziatikBot, {name}:\n"
@@ -192,38 +276,69 @@ async def choose_name(callback_query: CallbackQuery, bot: Bot):
 async def set_name(callback_query: CallbackQuery, bot: Bot):
     if callback_query.data == 'full_name':
         name = callback_query.from_user.full_name
-        remember(callback_query.from_user.id, name, field='name')
+        await remember(callback_query.from_user.id, name, field='name')
         await callback_query.answer(f'Хорошо, {name}')
     elif callback_query.data == 'username':
         name = callback_query.from_user.username
-        remember(callback_query.from_user.id, name, field='name')
+        await remember(callback_query.from_user.id, name, field='name')
         await callback_query.answer(f'Хорошо, {name}')
     elif callback_query.data == 'no-name':
-        forget_name(callback_query.from_user.id)
+        await forget_name(callback_query.from_user.id)
         await callback_query.answer('Ну, ладно... теперь у вас нет имени')
     else:
         await send_typing_indicator(callback_query.message.chat.id, bot)
-        keyboard_input[callback_query.from_user.id] = 'name'
+        await set_state(callback_query.from_user.id, 'name')
         await callback_query.answer('Хорошо, пишите', show_alert=True)
 
 
 async def memory(callback_query: CallbackQuery):
     if callback_query.data == 'remember':
         await callback_query.message.answer('Пишите, что нужно запомнить')
-        keyboard_input[callback_query.from_user.id] = 'remember'
+        await set_state(callback_query.from_user.id, 'remember')
 
     elif callback_query.data == 'recall':
         await callback_query.answer('Вспоминаю...')
         asyncio.create_task(send_typing_indicator(callback_query.message.chat.id, callback_query.bot))
-        await callback_query.message.answer('\n'.join(recall(callback_query.from_user.id)))
+        text, markup = await render_memory_page(callback_query.from_user.id)
+        await callback_query.message.answer(text, reply_markup=markup)
+
+    elif callback_query.data == 'search':
+        await set_state(callback_query.from_user.id, 'search')
+        await callback_query.answer()
+        await callback_query.message.answer('Что найти в памяти?')
 
     else:
-        keyboard_input[callback_query.from_user.id] = 'forget'
+        await set_state(callback_query.from_user.id, 'forget')
         await callback_query.answer('Хорошо')
-        await callback_query.message.answer('Напишите номер объекта, который хотите удалить')
+        await callback_query.message.answer('Напишите номер объекта, который хотите удалить (можно "1, 5, 7" или "3-6")')
         await callback_query.message.answer('Или напишите "Все"')
         await send_typing_indicator(callback_query.message.chat.id, callback_query.bot, wait=3)
-        await callback_query.message.answer('\n'.join(recall(callback_query.from_user.id)))
+        text, markup = await render_memory_page(callback_query.from_user.id)
+        await callback_query.message.answer(text, reply_markup=markup)
+
+
+async def memory_pages(callback_query: CallbackQuery):
+    # callback_data: mem_page:<next|prev>:<id>
+    _, direction, data_id = callback_query.data.split(':')
+    if direction == 'next':
+        text, markup = await render_memory_page(callback_query.from_user.id, after_id=int(data_id))
+    else:
+        text, markup = await render_memory_page(callback_query.from_user.id, before_id=int(data_id))
+    await callback_query.answer()
+    await callback_query.message.edit_text(text, reply_markup=markup)
+
+
+async def memory_search_pages(callback_query: CallbackQuery):
+    # callback_data: mem_search:<offset>
+    # Последний поисковый запрос пользователя — для кнопок "Дальше"/"Назад"
+    query = await get_state(callback_query.from_user.id, SEARCH)
+    if not query:
+        await callback_query.answer('Поиск устарел, начните заново', show_alert=True)
+        return
+    offset = int(callback_query.data.split(':')[1])
+    text, markup = await render_search_page(callback_query.from_user.id, query, offset)
+    await callback_query.answer()
+    await callback_query.message.edit_text(text, reply_markup=markup)
 
 
 async def dev(message: Message):
@@ -249,8 +364,7 @@ async def donate(callback_query: CallbackQuery):
 
 
 async def feedback(message: Message):
-    global keyboard_input
-    keyboard_input[message.from_user.id] = 'feedback'
+    await set_state(message.from_user.id, 'feedback')
     await send_typing_indicator(message.chat.id, message.bot)
     await message.reply('_Напишите_ Ваш отзыв', parse_mode="Markdown")
 
@@ -263,33 +377,26 @@ async def voice_to_text(message: Message, bot: Bot):
     """
     download = None
     transcribe = None
-    ogg_path = None
-    wav_path = None
+    user_id = message.from_user.id
+    slot = None
+    done = False
     try:
-        # Проверяем и обновляем недельный лимит
-        user_id = message.from_user.id
-        now = int(time.time())
-        week_seconds = 7 * 24 * 60 * 60
-
-        # Инициализация недели, если не задана
-        start_ts = recall(user_id, "voice_time")
-        if not isinstance(start_ts, int):
-            start_ts = now
-            remember(user_id, start_ts, "voice_time")
-
-        # Сброс счётчика, если прошла неделя
-        if now - start_ts >= week_seconds:
-            remember(user_id, 0, "voice_counter")
-            start_ts = now
-            remember(user_id, start_ts, "voice_time")
-
-        counter = recall(user_id, "voice_counter")
-        if not isinstance(counter, int):
-            counter = 0
-            remember(user_id, counter, "voice_counter")
+        # Это голосовое уже расшифровывали (пересылки) — отвечаем сразу, без лимита и счёта
+        cached = await transcript_cache.get(message.voice.file_unique_id, CACHE_LANGUAGE)
+        if cached is not None:
+            await message.reply(f"Расшифрованный текст: {cached}")
+            return
+
+        # Очередь расшифровки переполнена — отказываем сразу, ничего не скачивая и не тратя лимит
+        if transcription_pool.pool.full():
+            await message.reply(BUSY_TEXT)
+            return
+
+        # Одним запросом: сброс недели, проверка лимита и резерв слота
+        slot = await reserve_voice_slot(user_id, int(time.time()))
 
         # Если лимит исчерпан — отправляем счёт и выходим
-        if counter >= 10:
+        if slot is None:
             await message.reply_invoice(
                 title="Лимит расшифровок",
                 description="Вы использовали 10 бесплатных расшифровок на этой неделе. Купите доступ за 5 Звёзд.",
@@ -300,29 +407,36 @@ async def voice_to_text(message: Message, bot: Bot):
             )
             return
 
-        # Скачиваем голосовое сообщение
-        voice_file = await bot.get_file(message.voice.file_id)
-        ogg_path = f"voice_{voice_file.file_id}.ogg"
+        # Скачиваем голосовое сообщение в память и декодируем OGG сразу в PCM
         download = await message.reply('Скачиваю сообщение')
-        await bot.download_file(voice_file.file_path, ogg_path)
-        # Конвертируем из OGG в WAV, так как SpeechRecognition лучше работает с WAV
-        wav_path = ogg_path.replace('.ogg', '.wav')
-        segment = await asyncio.to_thread(AudioSegment.from_file, ogg_path)
-        await asyncio.to_thread(segment.export, wav_path, format="wav")
+        audio_data = await voice_pipeline.load(bot, message.voice.file_id)
         asyncio.create_task(send_typing_indicator(message.chat.id, bot, wait=5))
         transcribe = await message.answer('Расшифровываю...')
-        # Расшифровываем аудио
-        text = await asyncio.to_thread(_transcribe_wav, wav_path)
+        # Расшифровываем аудио (пока ждём своей очереди — показываем место в ней)
+        # Длинные голосовые режутся по паузам и расшифровываются кусками параллельно
+        text, engine = await voice_pipeline.transcribe(
+            audio_data, _transcribe, VOICE_LANGUAGE,
+            on_position=lambda position: transcribe.edit_text(f'Расшифровываю... Вы {position}-й в очереди'),
+            on_partial=lambda partial: transcribe.edit_text(f'Расшифровываю...\n{_tail(partial)}'))
+        done = True
+        cache_language = speech_engines.cache_key(VOICE_LANGUAGE, engine)
+        await transcript_cache.put(message.voice.file_unique_id, cache_language, text)
         # Отправляем расшифрованный текст
-        await message.reply(f"Расшифрованный текст: {text}")
-        # Увеличиваем счётчик после успешной расшифровки
-        remember(user_id, counter + 1, 'voice_counter')
+        await _reply_text(message, f"Расшифрованный текст: {text}")
 
+    except transcription_pool.QueueFull:
+        await message.reply(BUSY_TEXT)
     except sr.UnknownValueError:
         await message.reply("Не удалось распознать речь.")
     except Exception as e:
         await message.reply(f"Произошла ошибка: {e}")
     finally:
+        # Расшифровка не удалась — возвращаем зарезервированный слот
+        if slot and not done:
+            try:
+                await release_voice_slot(user_id, slot['voice_time'])
+            except Exception:
+                pass
         try:
             if download:
                 await download.delete()
@@ -333,11 +447,6 @@ async def voice_to_text(message: Message, bot: Bot):
                 await transcribe.delete()
         except Exception:
             pass
-        # Удаляем временные файлы
-        if ogg_path and os.path.exists(ogg_path):
-            os.remove(ogg_path)
-        if wav_path and os.path.exists(wav_path):
-            os.remove(wav_path)
 
 
 async def inline_emojis(inline_query: InlineQuery):
@@ -429,28 +538,34 @@ async def successful_payment_handler(message: Message, bot: Bot):
 
     download = None
     transcribe_msg = None
-    ogg_path = None
-    wav_path = None
     try:
-        # Скачиваем голосовое сообщение по file_id из payload
         voice_file = await bot.get_file(voice_file_id)
-        ogg_path = f"voice_{voice_file.file_id}.ogg"
-        download = await message.reply('Скачиваю оплаченный голос')
-        await bot.download_file(voice_file.file_path, ogg_path)
+        # Пока ждали оплату, это голосовое могли уже расшифровать
+        cached = await transcript_cache.get(voice_file.file_unique_id, CACHE_LANGUAGE)
+        if cached is not None:
+            await message.reply(f"Расшифрованный текст (оплачено): {cached}")
+            return
 
-        # Конвертируем OGG в WAV
-        wav_path = ogg_path.replace('.ogg', '.wav')
-        segment = await asyncio.to_thread(AudioSegment.from_file, ogg_path)
-        await asyncio.to_thread(segment.export, wav_path, format="wav")
+        # Скачиваем голосовое сообщение по file_id из payload и декодируем в PCM
+        download = await message.reply('Скачиваю оплаченный голос')
+        audio_data = await voice_pipeline.load(bot, voice_file)
 
         asyncio.create_task(send_typing_indicator(message.chat.id, bot, wait=5))
         transcribe_msg = await message.answer('Расшифровываю (оплачено)...')
 
         # Расшифровываем
-        text = await asyncio.to_thread(_transcribe_wav, wav_path)
-        await message.reply(f"Расшифрованный текст (оплачено): {text}")
+        text, engine = await voice_pipeline.transcribe(
+            audio_data, _transcribe, VOICE_LANGUAGE,
+            on_position=lambda position: transcribe_msg.edit_text(
+                f'Расшифровываю (оплачено)... Вы {position}-й в очереди'),
+            on_partial=lambda partial: transcribe_msg.edit_text(f'Расшифровываю (оплачено)...\n{_tail(partial)}'))
+        cache_language = speech_engines.cache_key(VOICE_LANGUAGE, engine)
+        await transcript_cache.put(voice_file.file_unique_id, cache_language, text)
+        await _reply_text(message, f"Расшифрованный текст (оплачено): {text}")
 
         # Платная расшифровка — счётчик не изменяем
+    except transcription_pool.QueueFull:
+        await refund_and_notify(BUSY_TEXT)
     except sr.UnknownValueError:
         await refund_and_notify("Не удалось распознать речь по оплаченному сообщению.")
     except Exception as e:
@@ -466,48 +581,55 @@ async def successful_payment_handler(message: Message, bot: Bot):
                 await transcribe_msg.delete()
         except Exception:
             pass
-        if ogg_path and os.path.exists(ogg_path):
-            os.remove(ogg_path)
-        if wav_path and os.path.exists(wav_path):
-            os.remove(wav_path)
 
 
 async def everything(message: Message, bot: Bot):
     user_id = message.from_user.id
-    if keyboard_input.get(user_id) == 'name':
-        remember(user_id, message.text, field='name')
-        del keyboard_input[user_id]
+    # Ввод ожидается один раз: достаём состояние и сразу очищаем
+    state = await pop_state(user_id)
+    if state == 'name':
+        await remember(user_id, message.text, field='name')
         await message.answer(
             f'Запомнил! Теперь вы — '
-            f'{recall(user_id, field="name")}'
+            f'{await recall(user_id, field="name")}'
         )
-    elif keyboard_input.get(user_id) == 'feedback':
+    elif state == 'feedback':
         await send_typing_indicator(user_id, bot)
         await asyncio.create_task(send_typing_indicator(message.chat.id, bot, wait=3))
-        feedback_id = create_feedback(user_id, message.text)
+        feedback_id = await create_feedback(user_id, message.text)
         await message.answer(
             f"Сообщение зарегистрировано: номер — {feedback_id}"
         )
         await bot.send_message(MY_CHAT_ID,
-                               f'Хозяин, у тебя отзыв.\n {get_feedback(user_id, feedback_id)}')
-        del keyboard_input[user_id]
-    elif keyboard_input.get(user_id) == 'remember':
+                               f'Хозяин, у тебя отзыв.\n {await get_feedback(user_id, feedback_id)}')
+    elif state == 'remember':
         asyncio.create_task(send_typing_indicator(message.chat.id, bot, wait=3))
-        remember(user_id, message.text)
+        await remember(user_id, message.text)
         await message.answer(f'Запомнил!\n{message.text}')
-        del keyboard_input[user_id]
-    elif keyboard_input.get(user_id) == 'forget':
+    elif state == 'search':
+        query = message.text or ''
+        await set_state(user_id, query, SEARCH)
+        text, markup = await render_search_page(user_id, query)
+        await message.answer(text, reply_markup=markup)
+    elif state == 'forget':
         asyncio.create_task(send_typing_indicator(message.chat.id, bot, wait=2))
-        del keyboard_input[user_id]
         if message.text.lower() in ('все', 'всё'):
-            forget(user_id)
+            await forget(user_id)
             await message.reply('Удалил все записи')
             return
-        if message.text not in recall(user_id, 'id'):
+        ids = parse_ids(message.text)
+        # Проверка владельца и удаление — одним запросом
+        deleted = await forget_ids(user_id, ids) if ids else []
+        if not deleted:
             await message.answer('Такого ключа нет')
             return
-        forget(user_id, message.text)
-        await message.answer(f'Удалил ключ {message.text} и его значение')
+        if len(deleted) == 1:
+            await message.answer(f'Удалил ключ {deleted[0]} и его значение')
+        else:
+            await message.answer(f'Удалил ключи {", ".join(map(str, deleted))} и их значения')
+        missing = sorted(set(ids) - set(deleted))
+        if missing and len(missing) <= 20:
+            await message.answer(f'Не нашёл ключи: {", ".join(map(str, missing))}')
     else:
         # Отправляем стандартное предупреждение
         await message.reply(
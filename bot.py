@@ -1,9 +1,13 @@
+import argparse
 import asyncio
+import contextlib
+import inspect
 import os
 import socket
 import aiodns
 from aiogram import Bot, Dispatcher, Router, types, F
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiohttp import ClientSession, TCPConnector
 from aiohttp.resolver import AsyncResolver
 from aiogram.filters import Command
@@ -11,20 +15,28 @@ from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 
 import beta_bot
+import cache_sync
 import stable_bot
-from db import recall, remember
-
-
-def _select_module(user_id: int):
+import db_async
+import speech_engines
+import storage_backend
+import supervisor
+import transcription_pool
+import webhook
+from db_async import recall, remember
+from outbound import OutboundLimiter
+from update_scheduler import UpdateScheduler
+
+
+async def _select_module(user_id: int):
     try:
-        return beta_bot if recall(user_id, field='beta') == 'True' else stable_bot
+        return beta_bot if await recall(user_id, field='beta') == 'True' else stable_bot
     except Exception:
         # Fallback to stable on any recall issues
         return stable_bot
 
 
-def _dispatch(func_name: str, user_id: int):
-    mod = _select_module(user_id)
+def _resolve(mod, func_name: str):
     # If function not present in selected module, fallback to beta version if available
     if hasattr(mod, func_name):
         return getattr(mod, func_name)
@@ -35,6 +47,11 @@ def _dispatch(func_name: str, user_id: int):
     return getattr(stable_bot, func_name)
 
 
+async def _dispatch(func_name: str, user_id: int, *args):
+    mod = await _select_module(user_id)
+    return await _resolve(mod, func_name)(*args)
+
+
 load_dotenv()
 
 # ======== Config ========
@@ -55,67 +72,77 @@ router = Router()
 
 @router.message(Command('start'))
 async def start_bot(message: Message):
-    await _dispatch('start_bot', message.from_user.id)(message)
+    await _dispatch('start_bot', message.from_user.id, message)
 
 
 @router.message(lambda msg: msg.text == 'info')
 async def info(message: Message):
-    await _dispatch('info', message.from_user.id)(message)
+    await _dispatch('info', message.from_user.id, message)
 
 
 @router.callback_query(F.data == 'status')
 async def status(callback_query: types.CallbackQuery):
-    await _dispatch('status', callback_query.from_user.id)(callback_query)
+    await _dispatch('status', callback_query.from_user.id, callback_query)
 
 
 @router.callback_query(F.data == 'changelog')
 async def changelog(callback_query: types.CallbackQuery):
-    await _dispatch('changelog', callback_query.from_user.id)(callback_query)
+    await _dispatch('changelog', callback_query.from_user.id, callback_query)
 
 
 @router.message(lambda msg: msg.text in ["Кубик", 'Roll a die'])
 async def roll_dice(message: Message, bot: Bot):
-    await _dispatch('roll_dice', message.from_user.id)(message, bot)
+    await _dispatch('roll_dice', message.from_user.id, message, bot)
 
 
 @router.message(lambda msg: msg.text in ['Memory', 'Память'])
 async def memory_menu(message: Message):
-    await _dispatch('memory_menu', message.from_user.id)(message)
+    await _dispatch('memory_menu', message.from_user.id, message)
 
 
 @router.message(lambda msg: msg.text in ['Меню', 'Menu'])
 async def menu(message: Message):
-    await _dispatch('menu', message.from_user.id)(message)
+    await _dispatch('menu', message.from_user.id, message)
 
 
 @router.callback_query(F.data == 'name')
 async def choose_name(callback_query: types.CallbackQuery, bot: Bot):
-    await _dispatch('choose_name', callback_query.from_user.id)(callback_query, bot)
+    await _dispatch('choose_name', callback_query.from_user.id, callback_query, bot)
 
 
 @router.callback_query(F.data.in_(['full_name', 'username', 'keyboard_input', 'no-name']))
 async def set_name(callback_query: types.CallbackQuery, bot: Bot):
-    await _dispatch('set_name', callback_query.from_user.id)(callback_query, bot)
+    await _dispatch('set_name', callback_query.from_user.id, callback_query, bot)
 
 
-@router.callback_query(F.data.in_(['remember', 'recall', 'forget']))
+@router.callback_query(F.data.in_(['remember', 'recall', 'search', 'forget']))
 async def memory(callback_query: types.CallbackQuery):
-    await _dispatch('memory', callback_query.from_user.id)(callback_query)
+    await _dispatch('memory', callback_query.from_user.id, callback_query)
+
+
+@router.callback_query(F.data.startswith('mem_page:'))
+async def memory_pages(callback_query: types.CallbackQuery):
+    await _dispatch('memory_pages', callback_query.from_user.id, callback_query)
+
+
+@router.callback_query(F.data.startswith('mem_search:'))
+async def memory_search_pages(callback_query: types.CallbackQuery):
+    await _dispatch('memory_search_pages', callback_query.from_user.id, callback_query)
 
 
 @router.message(F.text == 'dev')
 async def dev(message: Message):
-    await _dispatch('dev', message.from_user.id)(message)
+    await _dispatch('dev', message.from_user.id, message)
 
 
 @router.callback_query(F.data == 'donate')
 async def donate(callback_query: types.CallbackQuery):
-    await _dispatch('donate', callback_query.from_user.id)(callback_query)
+    await _dispatch('donate', callback_query.from_user.id, callback_query)
 
 
 @router.message(lambda msg: msg.text in ['Вопрос/Отзыв', 'Feedback'])
 async def feedback(message: Message):
-    await _dispatch('feedback', message.from_user.id)(message)
+    await _dispatch('feedback', message.from_user.id, message)
 
 
 @router.message(F.voice)
@@ -125,12 +152,12 @@ async def voice_to_text(message: Message, bot: Bot):
     Добавлен недельный лимит: 10 бесплатных расшифровок на пользователя.
     При превышении отправляется счёт на 5 Stars.
     """
-    await _dispatch('voice_to_text', message.from_user.id)(message, bot)
+    await _dispatch('voice_to_text', message.from_user.id, message, bot)
 
 
 @router.inline_query()
 async def inline_emojis(inline_query: types.InlineQuery):
-    await _dispatch('inline_emojis', inline_query.from_user.id)(inline_query)
+    await _dispatch('inline_emojis', inline_query.from_user.id, inline_query)
 
 
 @router.callback_query(F.data == 'chanel')
@@ -148,32 +175,112 @@ async def chanel(callback_query: types.CallbackQuery):
 
 @router.callback_query(F.data == 'beta')
 async def beta(callback_query: types.CallbackQuery):
-    remember(callback_query.from_user.id, 'True', 'beta')
+    await remember(callback_query.from_user.id, 'True', 'beta')
     await callback_query.message.edit_text(text='Готово, теперь вы будете использовать beta-версию')
 
 
 @router.callback_query(F.data == 'stable')
 async def stable(callback_query: types.CallbackQuery):
-    remember(callback_query.from_user.id, 'False', 'beta')
+    await remember(callback_query.from_user.id, 'False', 'beta')
     await callback_query.message.edit_text(text='Готово, теперь вы будете использовать стабильную версию')
 
 
 @router.pre_checkout_query()
 async def pre_checkout_handler(pre_checkout_query: types.PreCheckoutQuery, bot: Bot):
-    await _dispatch('pre_checkout_handler', pre_checkout_query.from_user.id)(pre_checkout_query, bot)
+    await _dispatch('pre_checkout_handler', pre_checkout_query.from_user.id, pre_checkout_query, bot)
 
 
 @router.message(F.successful_payment)
 async def successful_payment_handler(message: types.Message, bot: Bot):
-    await _dispatch('successful_payment_handler', message.from_user.id)(message, bot)
+    await _dispatch('successful_payment_handler', message.from_user.id, message, bot)
 
 
 @router.message()
 async def everything(message: Message, bot: Bot):
-    await _dispatch('everything', message.from_user.id)(message, bot)
-
-
-async def main():
+    await _dispatch('everything', message.from_user.id, message, bot)
+
+
+# ======== Routing table ========
+# fast_router is included before router: exact button texts and callback_data
+# are resolved with one dict lookup, and plain text goes straight to
+# everything() instead of failing every filter above first. Anything the
+# tables do not cover (commands, voice, payments, inline queries, ...) falls
+# through to the registrations above.
+
+fast_router = Router()
+
+
+def _route(handler):
+    return handler, 'bot' in inspect.signature(handler).parameters
+
+
+MESSAGE_ROUTES = {
+    'info': _route(info),
+    'Кубик': _route(roll_dice), 'Roll a die': _route(roll_dice),
+    'Память': _route(memory_menu), 'Memory': _route(memory_menu),
+    'Меню': _route(menu), 'Menu': _route(menu),
+    'Вопрос/Отзыв': _route(feedback), 'Feedback': _route(feedback),
+    'dev': _route(dev),
+}
+CALLBACK_ROUTES = {
+    'status': _route(status),
+    'changelog': _route(changelog),
+    'name': _route(choose_name),
+    **dict.fromkeys(['full_name', 'username', 'keyboard_input', 'no-name'], _route(set_name)),
+    **dict.fromkeys(['remember', 'recall', 'search', 'forget'], _route(memory)),
+    'donate': _route(donate),
+    'chanel': _route(chanel),
+    'beta': _route(beta),
+    'stable': _route(stable),
+}
+# callback_data of the form "<prefix>:<args>"
+CALLBACK_PREFIXES = {
+    'mem_page': _route(memory_pages),
+    'mem_search': _route(memory_search_pages),
+}
+_EVERYTHING = _route(everything)
+
+
+# Filters are coroutines: aiogram runs plain-function filters in a thread pool
+async def _message_route(message: Message):
+    text = message.text
+    if text is None or text.startswith('/'):
+        return False
+    return {'fast_route': MESSAGE_ROUTES.get(text, _EVERYTHING)}
+
+
+async def _callback_route(callback_query: types.CallbackQuery):
+    data = callback_query.data
+    if data is None:
+        return False
+    prefix, sep, _ = data.partition(':')
+    route = CALLBACK_ROUTES.get(data) or (sep and CALLBACK_PREFIXES.get(prefix))
+    return {'fast_route': route} if route else False
+
+
+@fast_router.message(_message_route)
+async def routed_message(message: Message, bot: Bot, fast_route):
+    handler, takes_bot = fast_route
+    await (handler(message, bot) if takes_bot else handler(message))
+
+
+@fast_router.callback_query(_callback_route)
+async def routed_callback(callback_query: types.CallbackQuery, bot: Bot, fast_route):
+    handler, takes_bot = fast_route
+    await (handler(callback_query, bot) if takes_bot else handler(callback_query))
+
+
+def build_dispatcher():
+    dp = Dispatcher()
+    scheduler = UpdateScheduler()
+    dp.update.outer_middleware(scheduler)
+    dp.include_routers(fast_router, router)
+    return dp, scheduler
+
+
+@contextlib.asynccontextmanager
+async def running_bot():
+    """Bot on our aiohttp session, with the storage background tasks around it."""
     loop = asyncio.get_event_loop()
     resolver = AsyncResolver(loop=loop)
 
@@ -184,21 +291,53 @@ async def main():
         session_wrapper = AiohttpSession()
         session_wrapper._session = aio_session
         session_wrapper._should_reset_connector = False
+        if os.getenv('TELEGRAM_API_URL'):
+            # Local Bot API server, or fake_telegram.py in tests
+            session_wrapper.api = TelegramAPIServer.from_base(os.getenv('TELEGRAM_API_URL'))
 
         bot = Bot(token=api_token_muziatikbot, session=session_wrapper)
-        dp = Dispatcher()
-        dp.include_router(router)
+        bot.session.middleware(OutboundLimiter())
 
-        print("Bot is live")
+        # An embedded store lives in this process, there is no other cache to sync with
+        if not storage_backend.embedded():
+            cache_sync.start()
 
         try:
-            await dp.start_polling(bot)
+            yield bot
         finally:
             await bot.session.close()
+            await cache_sync.stop()
+            await db_async.close_pool()
+            transcription_pool.pool.shutdown()
+
+
+async def main(mode: str = 'polling'):
+    async with running_bot() as bot:
+        dp, scheduler = build_dispatcher()
+        print("Bot is live")
+        try:
+            if mode == 'webhook':
+                await webhook.serve(bot, dp, stats=lambda: {'scheduler': scheduler.stats(),
+                                                         'transcription': transcription_pool.pool.snapshot(),
+                                                         'speech': speech_engines.stats()})
+            else:
+                await dp.start_polling(bot)
+        finally:
+            print(f'Update scheduler: {scheduler.stats()}')
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--webhook', dest='mode', action='store_const', const='webhook',
+                        help='receive updates over HTTP, see webhook.py')
+    parser.add_argument('--polling', dest='mode', action='store_const', const='polling')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('BOT_WORKERS', '0')),
+                        help='poll in this process and handle updates in N worker processes, see supervisor.py')
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.workers > 0:
+            asyncio.run(supervisor.run(args.workers))
+        else:
+            asyncio.run(main(args.mode or os.getenv('BOT_MODE', 'polling')))
     except KeyboardInterrupt:
         print("Stopping the bot...")
@@ -0,0 +1,86 @@
+"""Cross-process cache invalidation over Postgres LISTEN/NOTIFY.
+
+Writers in db.py / db_async.py send ``pg_notify(CHANNEL, '<kind>:<tg_id>')``
+inside their transaction, so the message is delivered only on commit. Every
+bot process runs start() once; the listener evicts the user from
+user_cache.
+"""
+import asyncio
+import os
+
+import asyncpg
+from dotenv import load_dotenv
+
+import user_cache
+
+load_dotenv()
+
+CHANNEL = 'muziatik_cache'
+RECONNECT_DELAY = float(os.getenv('CACHE_SYNC_RECONNECT_DELAY', '5'))
+
+_task = None
+_stats = {'received': 0, 'reconnects': 0}
+
+
+def payload(kind: str, tg_id: int) -> str:
+    return f'{kind}:{tg_id}'
+
+
+def _on_notification(connection, pid, channel, message):
+    try:
+        kind, tg_id = message.split(':', 1)
+        tg_id = int(tg_id)
+    except ValueError:
+        return
+    _stats['received'] += 1
+    if kind == 'users':
+        user_cache.invalidate(tg_id)
+
+
+async def _listen_forever():
+    while True:
+        con = None
+        try:
+            con = await asyncpg.connect(
+                database=os.getenv('DATABASE'),
+                user=os.getenv('DBUSER'),
+                password=os.getenv('DB_PSWD'),
+                host='localhost',
+                port=5432,
+            )
+            closed = asyncio.Event()
+            con.add_termination_listener(lambda _: closed.set())
+            await con.add_listener(CHANNEL, _on_notification)
+            # Anything could have changed while we were not listening
+            user_cache.clear()
+            await closed.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f'cache_sync listener error: {e}')
+        finally:
+            if con is not None and not con.is_closed():
+                await con.close()
+        _stats['reconnects'] += 1
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+def start() -> None:
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.get_running_loop().create_task(_listen_forever())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+def stats() -> dict:
+    return {**_stats, 'listening': _task is not None and not _task.done()}
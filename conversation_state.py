@@ -0,0 +1,122 @@
+"""Per-user conversation state shared by stable_bot and beta_bot.
+
+Replaces the module-level keyboard_input / search_queries dicts. A user
+has a few named slots ('input' is the step waiting for a typed reply,
+'search' the last search query); every value expires STATE_TTL seconds
+after it was set.
+
+STATE_BACKEND=memory (default) keeps the slots in a bounded LRU
+(STATE_MAX_ENTRIES), which is lost on restart. STATE_BACKEND=postgres
+stores them in the conversation_state table (migration 0005), so several
+worker processes and restarts see the same state.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+import db_async
+
+load_dotenv()
+
+BACKEND = os.getenv('STATE_BACKEND', 'memory').lower()
+TTL = float(os.getenv('STATE_TTL', '3600'))
+MAX_ENTRIES = int(os.getenv('STATE_MAX_ENTRIES', '10000'))
+# Expired rows in Postgres are purged at most this often
+PURGE_INTERVAL = float(os.getenv('STATE_PURGE_INTERVAL', '300'))
+
+INPUT = 'input'
+SEARCH = 'search'
+
+_entries = OrderedDict()  # (tg_id, key) -> (expires_at, value)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+_last_purge = 0.0
+
+
+async def get_state(user_id: int, key: str = INPUT):
+    """Current value of the slot, or None if it was never set or has expired."""
+    if BACKEND == 'postgres':
+        pool = await db_async.get_pool()
+        value = await pool.fetchval(
+            'SELECT value FROM conversation_state WHERE tg_id = $1 AND key = $2 AND expires_at > now()',
+            user_id, key)
+        _stats['hits' if value is not None else 'misses'] += 1
+        return value
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get((user_id, key))
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                del _entries[(user_id, key)]
+                _stats['expired'] += 1
+            _stats['misses'] += 1
+            return None
+        _entries.move_to_end((user_id, key))
+        _stats['hits'] += 1
+        return entry[1]
+
+
+async def set_state(user_id: int, value: str, key: str = INPUT, ttl: float = None) -> None:
+    ttl = TTL if ttl is None else ttl
+    if BACKEND == 'postgres':
+        pool = await db_async.get_pool()
+        await pool.execute(
+            """
+            INSERT INTO conversation_state (tg_id, key, value, expires_at)
+            VALUES ($1, $2, $3, now() + make_interval(secs => $4))
+            ON CONFLICT (tg_id, key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+            """,
+            user_id, key, value, ttl)
+        await _purge_expired(pool)
+        return
+    now = time.monotonic()
+    with _lock:
+        _entries[(user_id, key)] = (now + ttl, value)
+        _entries.move_to_end((user_id, key))
+        # Abandoned flows sit at the old end; drop the expired ones there
+        while _entries and next(iter(_entries.values()))[0] < now:
+            _entries.popitem(last=False)
+            _stats['expired'] += 1
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+async def pop_state(user_id: int, key: str = INPUT):
+    """Return the slot's value (None if unset or expired) and clear it, as one step."""
+    if BACKEND == 'postgres':
+        pool = await db_async.get_pool()
+        row = await pool.fetchrow(
+            'DELETE FROM conversation_state WHERE tg_id = $1 AND key = $2 RETURNING value, expires_at > now() AS live',
+            user_id, key)
+        value = row['value'] if row and row['live'] else None
+        _stats['hits' if value is not None else 'misses'] += 1
+        return value
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.pop((user_id, key), None)
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                _stats['expired'] += 1
+            _stats['misses'] += 1
+            return None
+        _stats['hits'] += 1
+        return entry[1]
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_stats, 'size': len(_entries), 'backend': BACKEND}
+
+
+async def _purge_expired(pool) -> None:
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    status = await pool.execute('DELETE FROM conversation_state WHERE expires_at <= now()')
+    _stats['expired'] += int(status.split()[-1])
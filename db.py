@@ -1,51 +1,83 @@
-import datetime
-import os
-
-import psycopg2
 from dotenv import load_dotenv
 
+import cache_sync
+import user_cache
+from audit_log import audit
+from db_pool import get_pool
+
 load_dotenv()
 
+# Free voice transcriptions per user per window
+VOICE_LIMIT = 10
+VOICE_WINDOW = 7 * 24 * 60 * 60
+# Memory entries per page in recall_page()
+PAGE_SIZE = 10
+
 
 def connect_db():
-    con = psycopg2.connect(
-        dbname=os.getenv('DATABASE'),
-        user=os.getenv('DBUSER'),
-        password=os.getenv('DB_PSWD'),
-        host='localhost',
-        port='5432',
-    )
+    """Borrow a connection from the pool; con.close() returns it."""
+    con = get_pool().getconn()
     cur = con.cursor()
     return cur, con
 
 
 def log_event(event, user_id, value, field, extra=''):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    log_msg = f"[{timestamp}] {event}: user_id={user_id}, field={field}, value={value} {extra}"
-    with open('memory_log.txt', 'a', encoding='utf-8') as logf:
-        logf.write(log_msg + '\n')
-    print(log_msg)
+    record = {'user_id': user_id, 'field': field, 'value': value}
+    if extra:
+        record['extra'] = extra
+    audit.log(event, **record)
+
+
+def _notify(cur, kind: str, user_id: int):
+    # Delivered to other processes on commit, see cache_sync
+    cur.execute('SELECT pg_notify(%s, %s)', (cache_sync.CHANNEL, cache_sync.payload(kind, user_id)))
+
+
+def get_user(user_id: int):
+    """Return the users row as a dict (None for unknown users), cached."""
+    row = user_cache.get(user_id)
+    if row is not user_cache.MISS:
+        return row
+    seen = user_cache.version()
+    cur, con = connect_db()
+    try:
+        cur.execute('''
+                    SELECT name, beta, voice_time, voice_counter
+                    FROM users
+                    WHERE tg_id = %s''', (user_id,))
+        record = cur.fetchone()
+    finally:
+        con.close()
+    row = dict(zip(('name', 'beta', 'voice_time', 'voice_counter'), record)) if record else None
+    if row is not None:
+        user_cache.mark_known(user_id)
+    user_cache.put(user_id, row, seen)
+    return row
 
 
 def remember(user_id: int, value, field=None):
     """Save or update a field for a specific user (nested dictionary)."""
     cur, con = connect_db()
     try:
-        cur.execute('''
-                    INSERT
-                    INTO users (tg_id)
-                    values (%s)
-                    on conflict do nothing
-                    ''', (user_id,))
-        con.commit()
         if field in ('name', 'voice_time', 'voice_counter', 'beta'):
+            # One UPSERT covers both new and existing users
             cur.execute(f'''
-                        UPDATE users
-                        SET {field} = %s
-                        WHERE tg_id = %s
-                        ''', (value, user_id))
+                        INSERT INTO users (tg_id, {field})
+                        VALUES (%s, %s)
+                        ON CONFLICT (tg_id) DO UPDATE SET {field} = EXCLUDED.{field}
+                        ''', (user_id, value))
+            _notify(cur, 'users', user_id)
             log_event('FIELD_UPDATE', user_id, value, field)
         else:
+            if not user_cache.is_known(user_id):
+                cur.execute('''
+                            INSERT
+                            INTO users (tg_id)
+                            values (%s)
+                            on conflict do nothing
+                            ''', (user_id,))
+                if cur.rowcount:
+                    _notify(cur, 'users', user_id)
             cur.execute(
                 """
                 INSERT INTO memory (user_id, data)
@@ -59,34 +91,38 @@ def remember(user_id: int, value, field=None):
         con.commit()
     finally:
         con.close()
+    user_cache.mark_known(user_id)
+    user_cache.invalidate(user_id)
 
 
 # remember(1183930315, 1, 'voice_counter')
 
 def recall(user_id: int, field=None):
+    if field in ('name', 'voice_time', 'voice_counter', 'beta'):
+        try:
+            row = get_user(user_id)
+        except Exception as e:
+            print(e)
+            return
+        result = row[field] if row else None
+        if not result:
+            return ['Нет элементов в памяти😔']
+        return result
     cur, con = connect_db()
     try:
-        if field in ('name', 'voice_time', 'voice_counter', 'beta'):
-            cur.execute(f'''
-                                 SELECT {field}
-                                 FROM users
-                                 WHERE tg_id = %s''', (user_id,))
-            row = cur.fetchone()
-            result = row[0] if row else None
+        cur.execute('''SELECT memory.id, data
+                       FROM memory
+                                JOIN users ON memory.user_id = users.id
+                       WHERE users.tg_id = %s
+                    ''', (user_id,))
+        result = list()
+        data = cur.fetchall()
+        if field == 'id':
+            for i in data:
+                result.append(str(i[0]))
         else:
-            cur.execute('''SELECT memory.id, data
-                           FROM memory
-                                    JOIN users ON memory.user_id = users.id
-                           WHERE users.tg_id = %s
-                        ''', (user_id,))
-            result = list()
-            data = cur.fetchall()
-            if field == 'id':
-                for i in data:
-                    result.append(str(i[0]))
-            else:
-                for i in data:
-                    result.append(str(i[0]) + ': ' + i[1])
+            for i in data:
+                result.append(str(i[0]) + ': ' + i[1])
         con.close()
         if not result:
             return ['Нет элементов в памяти😔']
@@ -96,6 +132,72 @@ def recall(user_id: int, field=None):
         con.close()
 
 
+def recall_page(user_id: int, after_id: int = None, before_id: int = None, limit: int = PAGE_SIZE):
+    """One keyset page of a user's memory: (rows, has_prev, has_next).
+
+    rows are (id, data) ordered by id. Pass the last id of a page as
+    after_id for the next page, or the first id as before_id for the
+    previous one. Rows are read through a server-side cursor, so the cost
+    depends on the page size, not on the size of the user's memory.
+    """
+    backwards = before_id is not None
+    cur, con = connect_db()
+    try:
+        page = con.cursor(name='memory_page')
+        page.itersize = limit + 1
+        page.execute(
+            f"""
+            SELECT id, data
+            FROM memory
+            WHERE user_id = (SELECT id FROM users WHERE tg_id = %s)
+              AND id {'<' if backwards else '>'} %s
+            ORDER BY id {'DESC' if backwards else 'ASC'}
+            LIMIT %s
+            """,
+            (user_id, before_id if backwards else (after_id or 0), limit + 1),
+        )
+        rows = page.fetchmany(limit + 1)
+        page.close()
+        con.commit()
+    finally:
+        con.close()
+    more = len(rows) > limit
+    rows = [(row[0], row[1]) for row in rows[:limit]]
+    if backwards:
+        return rows[::-1], more, True
+    return rows, after_id is not None, more
+
+
+def search_memory(user_id: int, query: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """Ranked full-text + fuzzy search in a user's memory: (rows, has_next).
+
+    rows are (id, data), best match first. Full-text matches use both the
+    Russian and English configurations; typos are caught by trigram word
+    similarity. Both go through the GIN indexes from migration 0004.
+    """
+    cur, con = connect_db()
+    try:
+        cur.execute(
+            """
+            WITH q AS (SELECT websearch_to_tsquery('russian', %(q)s) ||
+                              websearch_to_tsquery('english', %(q)s) AS ts)
+            SELECT m.id, m.data
+            FROM memory m,
+                 q
+            WHERE m.user_id = (SELECT id FROM users WHERE tg_id = %(tg_id)s)
+              AND (m.search @@ q.ts OR %(q)s <%% m.data)
+            ORDER BY ts_rank(m.search, q.ts) + word_similarity(%(q)s, m.data) DESC, m.id
+            LIMIT %(limit)s OFFSET %(offset)s
+            """,
+            {'tg_id': user_id, 'q': query, 'limit': limit + 1, 'offset': offset},
+        )
+        rows = cur.fetchall()
+        con.commit()
+    finally:
+        con.close()
+    return [(row[0], row[1]) for row in rows[:limit]], len(rows) > limit
+
+
 def forget(user_id: int, data_id: int = None):
     cur, con = connect_db()
     try:
@@ -116,6 +218,31 @@ def forget(user_id: int, data_id: int = None):
         con.close()
 
 
+def forget_ids(user_id: int, ids) -> list:
+    """Delete the user's memory entries with these ids; returns the ids actually removed."""
+    cur, con = connect_db()
+    try:
+        cur.execute(
+            """
+            WITH gone AS (
+                DELETE
+                FROM memory
+                WHERE user_id = (SELECT id FROM users WHERE tg_id = %(tg_id)s)
+                  AND id = ANY (%(ids)s::bigint[])
+                RETURNING id)
+            SELECT id
+            FROM gone
+            ORDER BY id
+            """,
+            {'tg_id': user_id, 'ids': [int(i) for i in ids]},
+        )
+        deleted = [row[0] for row in cur.fetchall()]
+        con.commit()
+        return deleted
+    finally:
+        con.close()
+
+
 def forget_name(user_id: int):
     cur, con = connect_db()
     try:
@@ -123,9 +250,72 @@ def forget_name(user_id: int):
                     UPDATE users
                     SET name = NULL
                     WHERE tg_id = %s''', (user_id,))
+        _notify(cur, 'users', user_id)
+        con.commit()
+    finally:
+        con.close()
+    user_cache.invalidate(user_id)
+
+
+def reserve_voice_slot(user_id: int, now: int, limit: int = VOICE_LIMIT, window: int = VOICE_WINDOW):
+    """Reset an expired window, check the limit and take one slot atomically.
+
+    Returns the users row ({'voice_time', 'voice_counter'}) after the
+    reservation, or None when the limit for the current window is used up.
+    """
+    cur, con = connect_db()
+    try:
+        cur.execute(
+            """
+            WITH slot AS (
+                INSERT INTO users AS u (tg_id, voice_time, voice_counter)
+                VALUES (%(tg_id)s, %(now)s, 1)
+                ON CONFLICT (tg_id) DO UPDATE
+                    SET voice_time    = CASE
+                                            WHEN u.voice_time IS NULL OR %(now)s - u.voice_time >= %(window)s
+                                                THEN %(now)s
+                                            ELSE u.voice_time END,
+                        voice_counter = CASE
+                                            WHEN u.voice_time IS NULL OR %(now)s - u.voice_time >= %(window)s
+                                                THEN 1
+                                            ELSE COALESCE(u.voice_counter, 0) + 1 END
+                    WHERE u.voice_time IS NULL
+                       OR %(now)s - u.voice_time >= %(window)s
+                       OR COALESCE(u.voice_counter, 0) < %(limit)s
+                RETURNING voice_time, voice_counter)
+            SELECT voice_time, voice_counter, pg_notify(%(channel)s, %(payload)s)
+            FROM slot
+            """,
+            {'tg_id': user_id, 'now': now, 'window': window, 'limit': limit,
+             'channel': cache_sync.CHANNEL, 'payload': cache_sync.payload('users', user_id)},
+        )
+        row = cur.fetchone()
+        con.commit()
+    finally:
+        con.close()
+    user_cache.invalidate(user_id)
+    return {'voice_time': row[0], 'voice_counter': row[1]} if row else None
+
+
+def release_voice_slot(user_id: int, voice_time: int) -> None:
+    """Give back a slot taken by reserve_voice_slot() if its window is still current."""
+    cur, con = connect_db()
+    try:
+        cur.execute(
+            """
+            UPDATE users
+            SET voice_counter = voice_counter - 1
+            WHERE tg_id = %s
+              AND voice_time = %s
+              AND voice_counter > 0
+            """,
+            (user_id, voice_time),
+        )
+        _notify(cur, 'users', user_id)
         con.commit()
     finally:
         con.close()
+    user_cache.invalidate(user_id)
 
 
 def create_feedback(user_id: int, message: str) -> int:
@@ -0,0 +1,348 @@
+"""asyncio version of the db.py API on top of an asyncpg pool.
+
+Queries go through asyncpg's per-connection statement cache, so every
+statement below is prepared once per connection and then reused.
+
+With an embedded STORAGE_BACKEND (see storage_backend.py) the functions of
+storage_backend.API are replaced at import time by thread-offloaded calls
+into that backend; the asyncpg pool is then never opened.
+"""
+import asyncio
+import functools
+import os
+
+import asyncpg
+from dotenv import load_dotenv
+
+import cache_sync
+import storage_backend
+import user_cache
+from db import log_event, VOICE_LIMIT, VOICE_WINDOW, PAGE_SIZE
+
+load_dotenv()
+
+USER_FIELDS = ('name', 'voice_time', 'voice_counter', 'beta')
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> asyncpg.Pool:
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await asyncpg.create_pool(
+                    database=os.getenv('DATABASE'),
+                    user=os.getenv('DBUSER'),
+                    password=os.getenv('DB_PSWD'),
+                    host='localhost',
+                    port=5432,
+                    min_size=int(os.getenv('DB_POOL_MIN', '1')),
+                    max_size=int(os.getenv('DB_POOL_MAX', '10')),
+                    max_inactive_connection_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+                    statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE', '100')),
+                )
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def _notify(con, kind: str, user_id: int):
+    # Delivered to other processes on commit, see cache_sync
+    await con.execute('SELECT pg_notify($1, $2)', cache_sync.CHANNEL, cache_sync.payload(kind, user_id))
+
+
+async def get_user(user_id: int):
+    """Return the users row as a dict (None for unknown users), cached."""
+    row = user_cache.get(user_id)
+    if row is not user_cache.MISS:
+        return row
+    seen = user_cache.version()
+    pool = await get_pool()
+    record = await pool.fetchrow(
+        'SELECT name, beta, voice_time, voice_counter FROM users WHERE tg_id = $1', user_id)
+    row = dict(record) if record else None
+    if row is not None:
+        user_cache.mark_known(user_id)
+    user_cache.put(user_id, row, seen)
+    return row
+
+
+async def remember(user_id: int, value, field=None):
+    """Save or update a field for a specific user (nested dictionary)."""
+    pool = await get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            if field in USER_FIELDS:
+                # One UPSERT covers both new and existing users
+                await con.execute(f'''
+                                  INSERT INTO users (tg_id, {field})
+                                  VALUES ($1, $2)
+                                  ON CONFLICT (tg_id) DO UPDATE SET {field} = EXCLUDED.{field}''',
+                                  user_id, value)
+                await _notify(con, 'users', user_id)
+                log_event('FIELD_UPDATE', user_id, value, field)
+            else:
+                if not user_cache.is_known(user_id):
+                    inserted = await con.execute(
+                        'INSERT INTO users (tg_id) VALUES ($1) ON CONFLICT DO NOTHING', user_id)
+                    if inserted != 'INSERT 0 0':
+                        await _notify(con, 'users', user_id)
+                await con.execute(
+                    """
+                    INSERT INTO memory (user_id, data)
+                    SELECT id, $1
+                    FROM users
+                    WHERE tg_id = $2
+                    """,
+                    value, user_id
+                )
+                log_event('MEMORY_INSERT', user_id, value, field)
+    user_cache.mark_known(user_id)
+    # After commit, so a concurrent reader cannot cache the old row again
+    user_cache.invalidate(user_id)
+
+
+async def recall(user_id: int, field=None):
+    try:
+        if field in USER_FIELDS:
+            row = await get_user(user_id)
+            result = row[field] if row else None
+        else:
+            pool = await get_pool()
+            async with pool.acquire() as con:
+                data = await con.fetch('''SELECT memory.id, data
+                                              FROM memory
+                                                       JOIN users ON memory.user_id = users.id
+                                              WHERE users.tg_id = $1
+                                           ''', user_id)
+            if field == 'id':
+                result = [str(i[0]) for i in data]
+            else:
+                result = [str(i[0]) + ': ' + i[1] for i in data]
+        if not result:
+            return ['Нет элементов в памяти😔']
+        return result
+    except Exception as e:
+        print(e)
+
+
+async def recall_page(user_id: int, after_id: int = None, before_id: int = None, limit: int = PAGE_SIZE):
+    """One keyset page of a user's memory: (rows, has_prev, has_next).
+
+    See db.recall_page(); rows are read through a server-side cursor.
+    """
+    backwards = before_id is not None
+    pool = await get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            page = await con.cursor(
+                f"""
+                SELECT id, data
+                FROM memory
+                WHERE user_id = (SELECT id FROM users WHERE tg_id = $1)
+                  AND id {'<' if backwards else '>'} $2
+                ORDER BY id {'DESC' if backwards else 'ASC'}
+                LIMIT $3
+                """,
+                user_id, before_id if backwards else (after_id or 0), limit + 1,
+            )
+            rows = await page.fetch(limit + 1)
+    more = len(rows) > limit
+    rows = [(row[0], row[1]) for row in rows[:limit]]
+    if backwards:
+        return rows[::-1], more, True
+    return rows, after_id is not None, more
+
+
+async def search_memory(user_id: int, query: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """Ranked full-text + fuzzy search in a user's memory: (rows, has_next).
+
+    See db.search_memory().
+    """
+    pool = await get_pool()
+    rows = await pool.fetch(
+        """
+        WITH q AS (SELECT websearch_to_tsquery('russian', $2) ||
+                          websearch_to_tsquery('english', $2) AS ts)
+        SELECT m.id, m.data
+        FROM memory m,
+             q
+        WHERE m.user_id = (SELECT id FROM users WHERE tg_id = $1)
+          AND (m.search @@ q.ts OR $2 <% m.data)
+        ORDER BY ts_rank(m.search, q.ts) + word_similarity($2, m.data) DESC, m.id
+        LIMIT $3 OFFSET $4
+        """,
+        user_id, query, limit + 1, offset,
+    )
+    return [(row[0], row[1]) for row in rows[:limit]], len(rows) > limit
+
+
+async def forget(user_id: int, data_id: int = None):
+    pool = await get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            if not data_id:
+                await con.execute('''
+                                  DELETE
+                                  FROM memory
+                                  WHERE user_id = (SELECT id FROM users WHERE tg_id = $1)''', user_id)
+            else:
+                await con.execute('''
+                                  DELETE
+                                  FROM memory
+                                  WHERE id = $1
+                                    AND user_id = (SELECT id FROM users WHERE tg_id = $2)''',
+                                  int(data_id), user_id)
+
+
+async def forget_ids(user_id: int, ids) -> list:
+    """Delete the user's memory entries with these ids; returns the ids actually removed."""
+    pool = await get_pool()
+    rows = await pool.fetch(
+        """
+        WITH gone AS (
+            DELETE
+            FROM memory
+            WHERE user_id = (SELECT id FROM users WHERE tg_id = $1)
+              AND id = ANY ($2::bigint[])
+            RETURNING id)
+        SELECT id
+        FROM gone
+        ORDER BY id
+        """,
+        user_id, [int(i) for i in ids],
+    )
+    return [row['id'] for row in rows]
+
+
+async def forget_name(user_id: int):
+    pool = await get_pool()
+    async with pool.acquire() as con:
+        async with con.transaction():
+            await con.execute('UPDATE users SET name = NULL WHERE tg_id = $1', user_id)
+            await _notify(con, 'users', user_id)
+    user_cache.invalidate(user_id)
+
+
+async def reserve_voice_slot(user_id: int, now: int, limit: int = VOICE_LIMIT, window: int = VOICE_WINDOW):
+    """Reset an expired window, check the limit and take one slot atomically.
+
+    Returns the users row ({'voice_time', 'voice_counter'}) after the
+    reservation, or None when the limit for the current window is used up.
+    """
+    pool = await get_pool()
+    row = await pool.fetchrow(
+        """
+        WITH slot AS (
+            INSERT INTO users AS u (tg_id, voice_time, voice_counter)
+            VALUES ($1, $2, 1)
+            ON CONFLICT (tg_id) DO UPDATE
+                SET voice_time    = CASE
+                                        WHEN u.voice_time IS NULL OR $2 - u.voice_time >= $3 THEN $2
+                                        ELSE u.voice_time END,
+                    voice_counter = CASE
+                                        WHEN u.voice_time IS NULL OR $2 - u.voice_time >= $3 THEN 1
+                                        ELSE COALESCE(u.voice_counter, 0) + 1 END
+                WHERE u.voice_time IS NULL
+                   OR $2 - u.voice_time >= $3
+                   OR COALESCE(u.voice_counter, 0) < $4
+            RETURNING voice_time, voice_counter)
+        SELECT voice_time, voice_counter, pg_notify($5, $6)
+        FROM slot
+        """,
+        user_id, now, window, limit, cache_sync.CHANNEL, cache_sync.payload('users', user_id),
+    )
+    user_cache.invalidate(user_id)
+    return {'voice_time': row['voice_time'], 'voice_counter': row['voice_counter']} if row else None
+
+
+async def release_voice_slot(user_id: int, voice_time: int) -> None:
+    """Give back a slot taken by reserve_voice_slot() if its window is still current."""
+    pool = await get_pool()
+    await pool.execute(
+        """
+        WITH slot AS (
+            UPDATE users
+            SET voice_counter = voice_counter - 1
+            WHERE tg_id = $1
+              AND voice_time = $2
+              AND voice_counter > 0
+            RETURNING tg_id)
+        SELECT pg_notify($3, $4)
+        FROM slot
+        """,
+        user_id, voice_time, cache_sync.CHANNEL, cache_sync.payload('users', user_id),
+    )
+    user_cache.invalidate(user_id)
+
+
+async def create_feedback(user_id: int, message: str) -> int:
+    pool = await get_pool()
+    return await pool.fetchval(
+        """
+        INSERT INTO feedback (user_id, message)
+        VALUES ((SELECT id FROM users WHERE tg_id = $1), $2)
+        RETURNING id
+        """,
+        user_id, message,
+    )
+
+
+async def get_feedback(user_id: int, _id=None):
+    pool = await get_pool()
+    if _id is None:
+        rows = await pool.fetch(
+            """
+            SELECT id, message
+            FROM feedback
+            WHERE user_id = (SELECT id FROM users WHERE tg_id = $1)
+            ORDER BY id
+            """,
+            user_id,
+        )
+    else:
+        rows = await pool.fetch(
+            """
+            SELECT id, message
+            FROM feedback
+            WHERE user_id = (SELECT id FROM users WHERE tg_id = $1)
+              AND id = $2
+            ORDER BY id
+            """,
+            user_id, int(_id),
+        )
+    return [(row[0], row[1]) for row in rows]
+
+
+async def delete_feedback(user_id: int, feedback_id: int) -> None:
+    pool = await get_pool()
+    await pool.execute(
+        """
+        DELETE
+        FROM feedback
+        WHERE id = $1
+          AND user_id = (SELECT id FROM users WHERE tg_id = $2)
+        """,
+        int(feedback_id), user_id,
+    )
+
+
+def _in_thread(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    return wrapper
+
+
+if storage_backend.embedded():
+    _backend = storage_backend.load()
+    for _name in storage_backend.API:
+        globals()[_name] = _in_thread(getattr(_backend, _name))
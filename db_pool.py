@@ -0,0 +1,240 @@
+"""Pool of long-lived psycopg2 connections used by db.connect_db()."""
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# ======== Config ========
+
+POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Seconds to wait for a free connection before giving up
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+# Idle connections older than this are pinged with SELECT 1 before reuse
+POOL_CHECK_AFTER = float(os.getenv('DB_POOL_CHECK_AFTER', '30'))
+# Connections are closed and replaced after this many seconds
+POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '3600'))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def new_connection():
+    return psycopg2.connect(
+        dbname=os.getenv('DATABASE'),
+        user=os.getenv('DBUSER'),
+        password=os.getenv('DB_PSWD'),
+        host='localhost',
+        port='5432',
+    )
+
+
+class PooledConnection:
+    """Proxy around a psycopg2 connection: close() hands it back to the pool."""
+
+    def __init__(self, pool, con, created):
+        self._pool = pool
+        self._con = con
+        self._created = created
+
+    def __getattr__(self, item):
+        if self._con is None:
+            raise psycopg2.InterfaceError('connection already returned to the pool')
+        return getattr(self._con, item)
+
+    def __enter__(self):
+        self._con.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._con.__exit__(exc_type, exc, tb)
+
+    def close(self):
+        if self._con is not None:
+            con, self._con = self._con, None
+            self._pool.putconn(con, self._created)
+
+
+class ConnectionPool:
+    def __init__(self, minconn=POOL_MIN, maxconn=POOL_MAX, factory=new_connection):
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self._factory = factory
+        self._idle = deque()  # (connection, created_at, returned_at)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._stats = {
+            'created': 0,
+            'recycled': 0,
+            'broken': 0,
+            'acquired': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'max_in_use': 0,
+        }
+
+    # ---- internals ----
+
+    def _check_fork(self):
+        # Connections must not be shared with a forked child
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+    def _count(self, key):
+        with self._cond:
+            self._stats[key] += 1
+
+    def _connect(self):
+        con = self._factory()
+        self._count('created')
+        return con
+
+    def _release(self, slots=1):
+        # Give back slots reserved for connections that were closed or never opened
+        with self._cond:
+            self._size -= slots
+            self._cond.notify(slots)
+
+    def _discard(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        self._release()
+
+    def _healthy(self, con, created, returned):
+        now = time.monotonic()
+        if con.closed:
+            self._count('broken')
+            return False
+        if now - created > POOL_MAX_LIFETIME:
+            self._count('recycled')
+            return False
+        if now - returned > POOL_CHECK_AFTER:
+            try:
+                with con.cursor() as cur:
+                    cur.execute('SELECT 1')
+                con.rollback()
+            except Exception:
+                self._count('broken')
+                return False
+        return True
+
+    def _fill(self):
+        with self._cond:
+            self._check_fork()
+            missing = max(self.minconn - self._size, 0)
+            self._size += missing
+        for left in range(missing, 0, -1):
+            try:
+                con = self._connect()
+            except Exception:
+                self._release(left)
+                return  # getconn() opens its own connection and reports the error
+            now = time.monotonic()
+            with self._cond:
+                self._idle.append((con, now, now))
+                self._cond.notify()
+
+    def _reserve(self, deadline, timeout):
+        """Pop an idle connection, or reserve a slot (None) for a new one."""
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self.maxconn:
+                    self._size += 1
+                    return None
+                self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f'no free database connection after {timeout}s')
+
+    # ---- public API ----
+
+    def getconn(self, timeout=POOL_TIMEOUT) -> PooledConnection:
+        # Only the bookkeeping runs under the lock: connecting and pinging
+        # must not block threads that borrow or return other connections
+        deadline = time.monotonic() + timeout
+        self._fill()
+        while True:
+            idle = self._reserve(deadline, timeout)
+            if idle is None:
+                try:
+                    con = self._connect()
+                except Exception:
+                    self._release()
+                    raise
+                return self._hand_out(con, time.monotonic())
+            con, created, returned = idle
+            if self._healthy(con, created, returned):
+                return self._hand_out(con, created)
+            self._discard(con)
+
+    def _hand_out(self, con, created):
+        with self._cond:
+            self._stats['acquired'] += 1
+            in_use = self._size - len(self._idle)
+            self._stats['max_in_use'] = max(self._stats['max_in_use'], in_use)
+        return PooledConnection(self, con, created)
+
+    def putconn(self, con, created):
+        if self._pid != os.getpid():
+            return
+        try:
+            if not con.closed and con.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                con.rollback()
+        except Exception:
+            pass
+        if con.closed or time.monotonic() - created > POOL_MAX_LIFETIME:
+            self._discard(con)
+            return
+        with self._cond:
+            self._idle.append((con, created, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for con, _, _ in idle:
+            self._discard(con)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                **self._stats,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'min': self.minconn,
+                'max': self.maxconn,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def pool_stats() -> dict:
+    return get_pool().stats()
@@ -0,0 +1,278 @@
+"""Embedded SQLite implementation of the db.py storage API.
+
+Same functions, arguments and return values as db.py, for small
+deployments and benchmark/test runs without a Postgres server. Selected
+with STORAGE_BACKEND=sqlite (see storage_backend.py); the file is
+SQLITE_PATH, muziatikBot.db by default.
+
+Each thread gets its own connection in WAL mode, so readers never block
+the writer.
+"""
+import os
+import sqlite3
+import threading
+
+from dotenv import load_dotenv
+
+from db import log_event, VOICE_LIMIT, VOICE_WINDOW, PAGE_SIZE
+
+load_dotenv()
+
+DB_PATH = os.getenv('SQLITE_PATH', 'muziatikBot.db')
+USER_FIELDS = ('name', 'voice_time', 'voice_counter', 'beta')
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA foreign_keys = ON',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users
+(
+    id            INTEGER PRIMARY KEY,
+    tg_id         INTEGER NOT NULL UNIQUE,
+    name          TEXT,
+    beta          TEXT,
+    voice_time    INTEGER,
+    voice_counter INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS memory
+(
+    id      INTEGER PRIMARY KEY,
+    user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    data    TEXT
+);
+CREATE INDEX IF NOT EXISTS memory_user_id_id_idx ON memory (user_id, id);
+
+CREATE TABLE IF NOT EXISTS feedback
+(
+    id      INTEGER PRIMARY KEY,
+    user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,
+    message TEXT
+);
+CREATE INDEX IF NOT EXISTS feedback_user_id_id_idx ON feedback (user_id, id);
+"""
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def connect_db():
+    """Per-thread connection; unlike db.connect_db() it stays open."""
+    global _schema_ready
+    con = getattr(_local, 'con', None)
+    if con is None:
+        con = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+        for pragma in PRAGMAS:
+            con.execute(pragma)
+        with _schema_lock:
+            if not _schema_ready:
+                con.executescript(SCHEMA)
+                _schema_ready = True
+        _local.con = con
+    return con.cursor(), con
+
+
+class _transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so read-modify-write is atomic
+    def __init__(self, con):
+        self.con = con
+
+    def __enter__(self):
+        self.con.execute('BEGIN IMMEDIATE')
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        self.con.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def get_user(user_id: int):
+    cur, con = connect_db()
+    row = cur.execute('SELECT name, beta, voice_time, voice_counter FROM users WHERE tg_id = ?',
+                      (user_id,)).fetchone()
+    return dict(zip(('name', 'beta', 'voice_time', 'voice_counter'), row)) if row else None
+
+
+def remember(user_id: int, value, field=None):
+    """Save or update a field for a specific user (nested dictionary)."""
+    cur, con = connect_db()
+    with _transaction(con):
+        if field in USER_FIELDS:
+            cur.execute(f'''
+                        INSERT INTO users (tg_id, {field})
+                        VALUES (?, ?)
+                        ON CONFLICT (tg_id) DO UPDATE SET {field} = excluded.{field}
+                        ''', (user_id, value))
+            log_event('FIELD_UPDATE', user_id, value, field)
+        else:
+            cur.execute('INSERT INTO users (tg_id) VALUES (?) ON CONFLICT DO NOTHING', (user_id,))
+            cur.execute('INSERT INTO memory (user_id, data) SELECT id, ? FROM users WHERE tg_id = ?',
+                        (value, user_id))
+            log_event('MEMORY_INSERT', user_id, value, field)
+
+
+def recall(user_id: int, field=None):
+    try:
+        if field in USER_FIELDS:
+            row = get_user(user_id)
+            result = row[field] if row else None
+        else:
+            cur, con = connect_db()
+            data = cur.execute('''SELECT memory.id, data
+                                  FROM memory
+                                           JOIN users ON memory.user_id = users.id
+                                  WHERE users.tg_id = ?
+                                  ORDER BY memory.id
+                               ''', (user_id,)).fetchall()
+            if field == 'id':
+                result = [str(i[0]) for i in data]
+            else:
+                result = [str(i[0]) + ': ' + i[1] for i in data]
+        if not result:
+            return ['Нет элементов в памяти😔']
+        return result
+    except Exception as e:
+        print(e)
+
+
+def recall_page(user_id: int, after_id: int = None, before_id: int = None, limit: int = PAGE_SIZE):
+    backwards = before_id is not None
+    cur, con = connect_db()
+    rows = cur.execute(
+        f"""
+        SELECT id, data
+        FROM memory
+        WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)
+          AND id {'<' if backwards else '>'} ?
+        ORDER BY id {'DESC' if backwards else 'ASC'}
+        LIMIT ?
+        """,
+        (user_id, before_id if backwards else (after_id or 0), limit + 1),
+    ).fetchall()
+    more = len(rows) > limit
+    rows = [(row[0], row[1]) for row in rows[:limit]]
+    if backwards:
+        return rows[::-1], more, True
+    return rows, after_id is not None, more
+
+
+def search_memory(user_id: int, query: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """Substring search ranked by the number of query words found (no FTS/trigram in SQLite)."""
+    words = [w.lower() for w in query.split() if w]
+    if not words:
+        return [], False
+    cur, con = connect_db()
+    rows = cur.execute(
+        f"""
+        SELECT id, data
+        FROM memory
+        WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)
+          AND ({' OR '.join(['instr(lower(data), ?) > 0'] * len(words))})
+        """,
+        (user_id, *words),
+    ).fetchall()
+    rows.sort(key=lambda row: (-sum(w in row[1].lower() for w in words), row[0]))
+    page = rows[offset:offset + limit]
+    return [(row[0], row[1]) for row in page], len(rows) > offset + limit
+
+
+def forget(user_id: int, data_id: int = None):
+    cur, con = connect_db()
+    with _transaction(con):
+        if not data_id:
+            cur.execute('DELETE FROM memory WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)', (user_id,))
+        else:
+            cur.execute('DELETE FROM memory WHERE id = ? AND user_id = (SELECT id FROM users WHERE tg_id = ?)',
+                        (int(data_id), user_id))
+
+
+def forget_ids(user_id: int, ids) -> list:
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    cur, con = connect_db()
+    with _transaction(con):
+        rows = cur.execute(
+            f"""
+            DELETE
+            FROM memory
+            WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)
+              AND id IN ({', '.join('?' * len(ids))})
+            RETURNING id
+            """,
+            (user_id, *ids),
+        ).fetchall()
+    return sorted(row[0] for row in rows)
+
+
+def forget_name(user_id: int):
+    cur, con = connect_db()
+    cur.execute('UPDATE users SET name = NULL WHERE tg_id = ?', (user_id,))
+
+
+def reserve_voice_slot(user_id: int, now: int, limit: int = VOICE_LIMIT, window: int = VOICE_WINDOW):
+    cur, con = connect_db()
+    with _transaction(con):
+        row = cur.execute('SELECT voice_time, voice_counter FROM users WHERE tg_id = ?', (user_id,)).fetchone()
+        voice_time, counter = row if row else (None, None)
+        if voice_time is None or now - voice_time >= window:
+            voice_time, counter = now, 0
+        counter = counter or 0
+        if counter >= limit:
+            return None
+        cur.execute('''
+                    INSERT INTO users (tg_id, voice_time, voice_counter)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (tg_id) DO UPDATE SET voice_time    = excluded.voice_time,
+                                                      voice_counter = excluded.voice_counter
+                    ''', (user_id, voice_time, counter + 1))
+    return {'voice_time': voice_time, 'voice_counter': counter + 1}
+
+
+def release_voice_slot(user_id: int, voice_time: int) -> None:
+    cur, con = connect_db()
+    cur.execute('''
+                UPDATE users
+                SET voice_counter = voice_counter - 1
+                WHERE tg_id = ?
+                  AND voice_time = ?
+                  AND voice_counter > 0
+                ''', (user_id, voice_time))
+
+
+def create_feedback(user_id: int, message: str) -> int:
+    cur, con = connect_db()
+    cur.execute('INSERT INTO feedback (user_id, message) VALUES ((SELECT id FROM users WHERE tg_id = ?), ?)',
+                (user_id, message))
+    return cur.lastrowid
+
+
+def get_feedback(user_id: int, _id=None):
+    cur, con = connect_db()
+    if _id is None:
+        rows = cur.execute('''
+                           SELECT id, message
+                           FROM feedback
+                           WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)
+                           ORDER BY id''', (user_id,)).fetchall()
+    else:
+        rows = cur.execute('''
+                           SELECT id, message
+                           FROM feedback
+                           WHERE user_id = (SELECT id FROM users WHERE tg_id = ?)
+                             AND id = ?
+                           ORDER BY id''', (user_id, int(_id))).fetchall()
+    return [(row[0], row[1]) for row in rows]
+
+
+def delete_feedback(user_id: int, feedback_id: int) -> None:
+    cur, con = connect_db()
+    cur.execute('DELETE FROM feedback WHERE id = ? AND user_id = (SELECT id FROM users WHERE tg_id = ?)',
+                (int(feedback_id), user_id))
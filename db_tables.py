@@ -1,54 +1,36 @@
-import os
+import sys
 
-from db import connect_db
+from migrations import migrate
 
-DB = "muziatikbot"
-print("Recreating schema in:", os.path.abspath(DB))
-
-cur, con = connect_db()
+# Schema now lives in migrations/*.sql and is applied by migrations.py.
+# "--drop" wipes all tables first (development only: destroys data).
 
 
 def drop():
-    cur.execute("""
-                DROP TABLE IF EXISTS feedback CASCADE;
-                DROP TABLE IF EXISTS memory CASCADE;
-                DROP TABLE IF EXISTS users CASCADE;
-                """)
+    from db import connect_db
+    cur, con = connect_db()
+    try:
+        cur.execute("""
+                    DROP TABLE IF EXISTS import_checkpoints CASCADE;
+                    DROP TABLE IF EXISTS transcripts CASCADE;
+                    DROP TABLE IF EXISTS conversation_state CASCADE;
+                    DROP TABLE IF EXISTS feedback CASCADE;
+                    DROP TABLE IF EXISTS memory CASCADE;
+                    DROP TABLE IF EXISTS users CASCADE;
+                    DROP TABLE IF EXISTS schema_migrations CASCADE;
+                    """)
+        con.commit()
+    finally:
+        con.close()
 
 
 def create():
-    cur.execute("""
-                CREATE TABLE if not exists users
-                (
-                    id            SMALLSERIAL PRIMARY KEY,
-                    tg_id         BIGINT NOT NULL UNIQUE,
-                    name          TEXT,
-                    beta          VARCHAR,
-                    voice_time    INTEGER,
-                    voice_counter INTEGER
-                );
-
-                CREATE TABLE if not exists memory
-                (
-                    id      SMALLSERIAL PRIMARY KEY,
-                    user_id INTEGER,
-                    data    TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                );
-
-                CREATE TABLE if not exists feedback
-                (
-                    id      SMALLSERIAL PRIMARY KEY,
-                    user_id INTEGER,
-                    message TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users (id)
-                );
-                """)
+    return migrate()
 
 
 if __name__ == '__main__':
-    drop()
-    create()
-    print("Done — tables recreated.")
-con.commit()
-con.close()
+    if '--drop' in sys.argv:
+        drop()
+        print("Dropped all tables.")
+    applied = create()
+    print(f"Done — schema is up to date ({len(applied)} migration(s) applied).")
@@ -0,0 +1,103 @@
+"""Local stand-in for Telegram to exercise webhook mode.
+
+    WEBHOOK_SECRET=test TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py --webhook
+    python fake_telegram.py --secret test --updates 1000 --users 50
+
+Serves a fake Bot API on --api-port (every method succeeds; send*/edit*
+return a message) and posts synthetic message updates to the bot's
+webhook, then prints ack latency and the Bot API calls the bot made.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import statistics
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, web
+
+TEXTS = ['info', 'Меню', 'Menu', 'Память', 'Кубик', 'привет', 'ghbdtn', 'hello there', 'dev']
+
+_ids = itertools.count(1)
+calls = Counter()
+
+
+def _message(chat_id: int, text: str = None, **extra) -> dict:
+    message = {'message_id': next(_ids), 'date': int(time.time()),
+               'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'}}
+    if text is not None:
+        message['text'] = text
+    return {**message, **extra}
+
+
+async def bot_api(request: web.Request):
+    method = request.match_info['method']
+    calls[method] += 1
+    params = dict(await request.post())
+    chat_id = int(params.get('chat_id') or 0)
+    if method == 'getMe':
+        result = {'id': 1, 'is_bot': True, 'first_name': 'MuziatikBot', 'username': 'muziatik_bot'}
+    elif method == 'sendDice':
+        result = _message(chat_id, dice={'emoji': '🎲', 'value': random.randint(1, 6)})
+    elif method.startswith(('send', 'edit', 'copy', 'forward')):
+        result = _message(chat_id, params.get('text', ''))
+    else:
+        result = True
+    return web.json_response({'ok': True, 'result': result})
+
+
+async def post_updates(url: str, secret: str, updates: int, users: int, concurrency: int):
+    latencies, statuses = [], Counter()
+    update_ids = itertools.count(1)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session: ClientSession):
+        user = random.randint(1, users)
+        update = {'update_id': next(update_ids), 'message': _message(user, random.choice(TEXTS))}
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, data=json.dumps(update),
+                                    headers={'Content-Type': 'application/json',
+                                             'X-Telegram-Bot-Api-Secret-Token': secret}) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - started)
+            statuses[response.status] += 1
+
+    async with ClientSession() as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(post(session) for _ in range(updates)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f'{updates} updates in {elapsed:.2f}s ({updates / elapsed:,.0f}/s), statuses {dict(statuses)}')
+    print(f'ack latency: p50 {statistics.median(latencies) * 1000:.1f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms, max {latencies[-1] * 1000:.1f} ms')
+
+
+async def main(args):
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', bot_api)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', args.api_port).start()
+    try:
+        await post_updates(args.url, args.secret, args.updates, args.users, args.concurrency)
+        # Give background handlers time to answer
+        await asyncio.sleep(args.settle)
+        print(f'Bot API calls: {dict(calls.most_common())}')
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080/webhook')
+    parser.add_argument('--secret', required=True)
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--updates', type=int, default=100)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--settle', type=float, default=2, help='seconds to wait for replies after posting')
+    asyncio.run(main(parser.parse_args()))
@@ -1,62 +1,301 @@
-# ======== JSON Storage Helpers (int user_id) ========
+# ======== Append-only Storage Helpers (int user_id) ========
+"""Embedded key-value store behind save_data / get_data / delete_data.
+
+Every change is appended as one JSON line to ``storage.log``:
+
+    {"op": "set", "u": "42", "f": "name", "v": "dima"}
+    {"op": "del", "u": "42", "f": "name"}
+    {"op": "del", "u": "42"}
+
+An in-memory index maps (user, field) to the offset of the latest "set"
+line, so a read is one seek + one line parse. Appends are fsync'ed in
+batches (every FSYNC_EVERY writes or FSYNC_INTERVAL seconds), a torn last
+line left by a crash is cut off by the next writer, and the log is rewritten with only
+live records once it is mostly garbage. Other processes appending to the
+same file are picked up on the next call (writes hold an flock).
+
+An existing storage.json is imported the first time the log is created.
+"""
+import atexit
 import json
 import os
+import threading
+import time
 from typing import Optional
 
+try:
+    import fcntl
+except ImportError:  # Windows: single-process use only
+    fcntl = None
+
+LOG_PATH = 'storage.log'
+LEGACY_PATH = 'storage.json'
+FSYNC_EVERY = int(os.getenv('STORAGE_FSYNC_EVERY', '64'))
+FSYNC_INTERVAL = float(os.getenv('STORAGE_FSYNC_INTERVAL', '1'))
+# Compact once dead records take more than this share of a file of at least COMPACT_MIN_BYTES
+COMPACT_RATIO = float(os.getenv('STORAGE_COMPACT_RATIO', '0.5'))
+COMPACT_MIN_BYTES = int(os.getenv('STORAGE_COMPACT_MIN_BYTES', str(1024 * 1024)))
+
+
+class LogStore:
+    def __init__(self, path=LOG_PATH, legacy_path=LEGACY_PATH):
+        self.path = path
+        self.legacy_path = legacy_path
+        self._index = {}  # user -> {field: (offset, length)}
+        self._file = None
+        self._inode = None
+        self._end = 0
+        self._live_bytes = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.RLock()
+        self._syncer = None
+
+    # ---- public API ----
+
+    def set(self, user: str, field: str, value) -> None:
+        with self._lock, self._flock():
+            self._catch_up(locked=True)
+            self._append({'op': 'set', 'u': user, 'f': field, 'v': value})
+
+    def get(self, user: str, field: str = None):
+        with self._lock:
+            self._catch_up()
+            fields = self._index.get(user, {})
+            if field is not None:
+                return self._read(fields[field])['v'] if field in fields else None
+            return {f: self._read(pos)['v'] for f, pos in fields.items()}
+
+    def delete(self, user: str, field: str = None) -> None:
+        with self._lock, self._flock():
+            self._catch_up(locked=True)
+            if user not in self._index or (field is not None and field not in self._index[user]):
+                return
+            record = {'op': 'del', 'u': user}
+            if field is not None:
+                record['f'] = field
+            self._append(record)
+
+    def users(self) -> list:
+        """Every user with at least one live field, in log order."""
+        with self._lock:
+            self._catch_up()
+            return list(self._index)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path) or os.path.exists(self.legacy_path)
+
+    def sync(self) -> None:
+        with self._lock:
+            if self._file is not None and self._unsynced:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+                self._last_sync = time.monotonic()
+
+    def compact(self) -> None:
+        """Rewrite the log with live records only."""
+        with self._lock, self._flock():
+            self._catch_up(locked=True)
+            self._compact()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+    # ---- internals ----
+
+    def _flock(self):
+        return _FileLock(self.path + '.lock')
+
+    @staticmethod
+    def _line(record) -> bytes:
+        return (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def _open(self, locked):
+        if self._file is not None:
+            return
+        if not os.path.exists(self.path):
+            if locked:
+                # flock is per open file: taking it again here would wait for ourselves
+                self._import_legacy()
+            else:
+                with self._flock():
+                    if not os.path.exists(self.path):
+                        self._import_legacy()
+        self._reopen(locked)
+
+    def _reopen(self, locked):
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'a+b')
+        self._inode = os.fstat(self._file.fileno()).st_ino
+        self._index = {}
+        self._end = 0
+        self._live_bytes = 0
+        self._replay(locked)
+
+    def _catch_up(self, locked=False):
+        """Bring the index up to date with appends/compactions by other processes."""
+        self._open(locked)
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if st is None or st.st_ino != self._inode:
+            self._file.close()
+            self._file = None
+            self._open(locked)
+        elif st.st_size > self._end:
+            self._replay(locked)
+
+    def _replay(self, locked):
+        self._file.seek(self._end)
+        while True:
+            offset = self._file.tell()
+            line = self._file.readline()
+            if not line:
+                break
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('torn write')
+                record = json.loads(line)
+            except ValueError:
+                # A crash in the middle of an append: drop the partial line.
+                # Without the write lock it may be another process still writing it.
+                if locked:
+                    self._file.truncate(offset)
+                break
+            self._apply(record, offset, len(line))
+            self._end = offset + len(line)
+        self._file.seek(0, os.SEEK_END)
+
+    def _apply(self, record, offset, length):
+        user = record['u']
+        fields = self._index.get(user, {})
+        if record['op'] == 'set':
+            old = fields.get(record['f'])
+            if old:
+                self._live_bytes -= old[1]
+            fields[record['f']] = (offset, length)
+            self._live_bytes += length
+            self._index[user] = fields
+        elif 'f' in record:
+            old = fields.pop(record['f'], None)
+            if old:
+                self._live_bytes -= old[1]
+            if not fields:
+                self._index.pop(user, None)
+        else:
+            self._live_bytes -= sum(pos[1] for pos in fields.values())
+            self._index.pop(user, None)
+
+    def _append(self, record):
+        line = self._line(record)
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        self._file.write(line)
+        self._file.flush()
+        self._apply(record, offset, len(line))
+        self._end = offset + len(line)
+        self._unsynced += 1
+        if self._unsynced >= FSYNC_EVERY or time.monotonic() - self._last_sync >= FSYNC_INTERVAL:
+            self.sync()
+        else:
+            self._start_syncer()
+        if self._end >= COMPACT_MIN_BYTES and self._live_bytes < self._end * (1 - COMPACT_RATIO):
+            self._compact()
+
+    def _compact(self):
+        # Caller holds the write lock
+        self.sync()
+        tmp = self.path + '.compact'
+        with open(tmp, 'wb') as out:
+            for user, fields in self._index.items():
+                for field, pos in fields.items():
+                    out.write(self._line({'op': 'set', 'u': user, 'f': field, 'v': self._read(pos)['v']}))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+        self._reopen(locked=True)
+
+    def _read(self, pos):
+        offset, length = pos
+        self._file.seek(offset)
+        record = json.loads(self._file.read(length))
+        self._file.seek(0, os.SEEK_END)
+        return record
+
+    def _start_syncer(self):
+        # Makes sure a lone write is fsync'ed within FSYNC_INTERVAL
+        if self._syncer is None or not self._syncer.is_alive():
+            self._syncer = threading.Timer(FSYNC_INTERVAL, self.sync)
+            self._syncer.daemon = True
+            self._syncer.start()
+
+    def _import_legacy(self):
+        if not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                data = json.load(f) or {}
+        except json.JSONDecodeError:
+            return
+        tmp = self.path + '.import'
+        with open(tmp, 'wb') as out:
+            for user, fields in data.items():
+                for field, value in fields.items():
+                    out.write(self._line({'op': 'set', 'u': user, 'f': field, 'v': value}))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+
+
+class _FileLock:
+    """Exclusive flock held while appending, so writers from several processes do not interleave."""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self._fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+_store = LogStore()
+atexit.register(_store.close)
+
 
 def save_data(user_id: int, field: str, value) -> None:
     """Save or update a field for a specific user (nested dictionary)."""
-    path = 'storage.json'
-    if os.path.exists(path):
-        with open(path, 'r+', encoding='utf-8') as f:
-            try:
-                data = json.load(f)  # Load existing data
-            except json.JSONDecodeError:
-                # If file is empty or invalid, initialize to empty dict
-                data = {}
-
-            user_data = data.get(str(user_id), {})  # Fix: user_id should be a string
-            user_data[field.lower()] = value.lower() if isinstance(value, str) else value
-            data[str(user_id)] = user_data
-            # Move the file pointer to the start before writing
-            f.seek(0)
-            f.truncate()
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    else:
-        # If a file doesn't exist, create a new one
-        with open(path, 'w', encoding='utf-8') as f:
-            data = {str(user_id): {field.lower(): value.lower() if isinstance(value, str) else value}}
-            json.dump(data, f, ensure_ascii=False, indent=2)
+    _store.set(str(user_id), field.lower(), value.lower() if isinstance(value, str) else value)
 
 
 def get_data(user_id: int, field: str = None) -> Optional[str]:
-    """Retrieve a field value by user ID from storage.json."""
-    try:
-        with open('storage.json', 'r', encoding='utf-8') as f:
-            data = json.load(f) or {}
-        user_data = data.get(str(user_id), {})
-        if field:
-            return user_data.get(field.lower() if field else None)
-        else:
-            # Filter out voice_week_start_ts and voice_counter from the returned data
-            return {k: v for k, v in user_data.items()
-                    if k not in ['voice_week_start_ts', 'voice_counter']}
-    except (FileNotFoundError, json.JSONDecodeError):
+    """Retrieve a field value by user ID from the storage log."""
+    if not _store.exists():
         return None
+    if field:
+        return _store.get(str(user_id), field.lower())
+    # Filter out voice_week_start_ts and voice_counter from the returned data
+    return {k: v for k, v in _store.get(str(user_id)).items()
+            if k not in ['voice_week_start_ts', 'voice_counter']}
 
 
 def delete_data(user_id: int, field: str = None) -> None:
     """Delete a field or the entire user entry."""
-    path = 'storage.json'
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f) or {}
-        if str(user_id) in data:
-            if field:
-                data[str(user_id)].pop(field.lower(), None)
-            else:
-                del data[str(user_id)]
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+    if not _store.exists():
+        return
+    _store.delete(str(user_id), field.lower() if field else None)
@@ -0,0 +1,137 @@
+"""Versioned schema migrations for the Postgres storage.
+
+Migrations are ``migrations/NNNN_<name>.sql`` files applied in order; each
+applied version is recorded in the ``schema_migrations`` table. A file whose
+first line is ``-- migrate: no-transaction`` runs statement by statement in
+autocommit mode (needed for CREATE INDEX CONCURRENTLY); all others run in a
+single transaction.
+
+    python migrations.py            # apply pending migrations
+    python migrations.py --status   # show applied / pending versions
+"""
+import hashlib
+import os
+import re
+import sys
+
+from db_pool import new_connection
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+NO_TRANSACTION = '-- migrate: no-transaction'
+# Arbitrary constant for pg_advisory_lock, so two processes never migrate at once
+LOCK_ID = 0x4D757A69
+
+_FILE_RE = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+
+def discover():
+    """Return [(version, name, path)] for every migration file, sorted."""
+    found = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = _FILE_RE.match(filename)
+        if match:
+            found.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    found.sort()
+    return found
+
+
+def _checksum(sql: str) -> str:
+    return hashlib.sha256(sql.encode('utf-8')).hexdigest()
+
+
+def _statements(sql: str):
+    # Migration files keep one statement per ';'-terminated line block
+    for statement in re.split(r';\s*\n', sql + '\n'):
+        lines = [line for line in statement.splitlines() if not line.strip().startswith('--')]
+        if '\n'.join(lines).strip():
+            yield statement.strip().rstrip(';')
+
+
+def _ensure_table(cur):
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations
+                (
+                    version    INTEGER PRIMARY KEY,
+                    name       TEXT        NOT NULL,
+                    checksum   TEXT        NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+
+
+def applied(cur) -> dict:
+    cur.execute('SELECT version, checksum FROM schema_migrations ORDER BY version')
+    return dict(cur.fetchall())
+
+
+def _apply(con, version, name, sql):
+    record = ('INSERT INTO schema_migrations (version, name, checksum) VALUES (%s, %s, %s)',
+              (version, name, _checksum(sql)))
+    if sql.lstrip().startswith(NO_TRANSACTION):
+        cur = con.cursor()
+        for statement in _statements(sql):
+            cur.execute(statement)
+        cur.execute(*record)
+        return
+    con.autocommit = False
+    try:
+        cur = con.cursor()
+        cur.execute(sql)
+        cur.execute(*record)
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.autocommit = True
+
+
+def migrate(target: int = None) -> list:
+    """Apply pending migrations up to ``target`` (all by default)."""
+    con = new_connection()
+    con.autocommit = True
+    done = []
+    try:
+        cur = con.cursor()
+        cur.execute('SELECT pg_advisory_lock(%s)', (LOCK_ID,))
+        try:
+            _ensure_table(cur)
+            seen = applied(cur)
+            for version, name, path in discover():
+                if target is not None and version > target:
+                    break
+                with open(path, encoding='utf-8') as f:
+                    sql = f.read()
+                if version in seen:
+                    if seen[version] != _checksum(sql):
+                        print(f'WARNING: migration {version:04d}_{name} changed after it was applied')
+                    continue
+                print(f'Applying {version:04d}_{name}...')
+                _apply(con, version, name, sql)
+                done.append(version)
+        finally:
+            cur.execute('SELECT pg_advisory_unlock(%s)', (LOCK_ID,))
+    finally:
+        con.close()
+    return done
+
+
+def status():
+    con = new_connection()
+    try:
+        cur = con.cursor()
+        _ensure_table(cur)
+        con.commit()
+        seen = applied(cur)
+    finally:
+        con.close()
+    for version, name, _ in discover():
+        print(f'{version:04d}_{name}: {"applied" if version in seen else "pending"}')
+
+
+if __name__ == '__main__':
+    if '--status' in sys.argv:
+        status()
+    else:
+        versions = migrate()
+        print(f'Done — applied {len(versions)} migration(s).')
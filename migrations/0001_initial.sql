@@ -0,0 +1,26 @@
+-- Schema as created by the original db_tables.py
+CREATE TABLE IF NOT EXISTS users
+(
+    id            SMALLSERIAL PRIMARY KEY,
+    tg_id         BIGINT NOT NULL UNIQUE,
+    name          TEXT,
+    beta          VARCHAR,
+    voice_time    INTEGER,
+    voice_counter INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS memory
+(
+    id      SMALLSERIAL PRIMARY KEY,
+    user_id INTEGER,
+    data    TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
+
+CREATE TABLE IF NOT EXISTS feedback
+(
+    id      SMALLSERIAL PRIMARY KEY,
+    user_id INTEGER,
+    message TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (id)
+);
@@ -0,0 +1,33 @@
+-- Widen SMALLSERIAL keys (max 32767) to BIGINT identity columns.
+-- Existing rows and their ids are kept. ALTER COLUMN ... TYPE rewrites each
+-- table and its indexes under an ACCESS EXCLUSIVE lock, so bots are blocked
+-- while this runs; with SMALLSERIAL's 32767-row cap that lock is brief.
+ALTER TABLE memory DROP CONSTRAINT IF EXISTS memory_user_id_fkey;
+ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_user_id_fkey;
+
+ALTER TABLE users ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE users ALTER COLUMN id TYPE BIGINT;
+DROP SEQUENCE IF EXISTS users_id_seq;
+ALTER TABLE users ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+SELECT setval(pg_get_serial_sequence('users', 'id'), COALESCE((SELECT MAX(id) FROM users), 0) + 1, false);
+
+ALTER TABLE memory ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE memory ALTER COLUMN id TYPE BIGINT;
+DROP SEQUENCE IF EXISTS memory_id_seq;
+ALTER TABLE memory ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+SELECT setval(pg_get_serial_sequence('memory', 'id'), COALESCE((SELECT MAX(id) FROM memory), 0) + 1, false);
+ALTER TABLE memory ALTER COLUMN user_id TYPE BIGINT;
+
+ALTER TABLE feedback ALTER COLUMN id DROP DEFAULT;
+ALTER TABLE feedback ALTER COLUMN id TYPE BIGINT;
+DROP SEQUENCE IF EXISTS feedback_id_seq;
+ALTER TABLE feedback ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY;
+SELECT setval(pg_get_serial_sequence('feedback', 'id'), COALESCE((SELECT MAX(id) FROM feedback), 0) + 1, false);
+ALTER TABLE feedback ALTER COLUMN user_id TYPE BIGINT;
+
+-- NOT VALID skips the full-table check here; 0007 validates the keys in its
+-- own transaction, which only needs a SHARE UPDATE EXCLUSIVE lock
+ALTER TABLE memory
+    ADD CONSTRAINT memory_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE NOT VALID;
+ALTER TABLE feedback
+    ADD CONSTRAINT feedback_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE NOT VALID;
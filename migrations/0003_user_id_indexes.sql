@@ -0,0 +1,4 @@
+-- migrate: no-transaction
+-- Built CONCURRENTLY so recall/forget/get_feedback keep working during the build
+CREATE INDEX CONCURRENTLY IF NOT EXISTS memory_user_id_id_idx ON memory (user_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS feedback_user_id_id_idx ON feedback (user_id, id);
@@ -0,0 +1,11 @@
+-- migrate: no-transaction
+-- Full-text (Russian + English) and trigram search over memory.data.
+-- btree_gin lets user_id share the GIN index, so a search only touches one user's entries.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+ALTER TABLE memory
+    ADD COLUMN IF NOT EXISTS search tsvector
+        GENERATED ALWAYS AS (to_tsvector('russian', coalesce(data, '')) ||
+                             to_tsvector('english', coalesce(data, ''))) STORED;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS memory_user_search_idx ON memory USING GIN (user_id, search);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS memory_user_data_trgm_idx ON memory USING GIN (user_id, data gin_trgm_ops);
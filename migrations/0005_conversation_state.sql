@@ -0,0 +1,10 @@
+-- Used by conversation_state.py with STATE_BACKEND=postgres
+CREATE TABLE IF NOT EXISTS conversation_state
+(
+    tg_id      BIGINT      NOT NULL,
+    key        TEXT        NOT NULL,
+    value      TEXT,
+    expires_at TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (tg_id, key)
+);
+CREATE INDEX IF NOT EXISTS conversation_state_expires_at_idx ON conversation_state (expires_at);
@@ -0,0 +1,13 @@
+-- Finished transcriptions, see transcript_cache.py
+CREATE TABLE IF NOT EXISTS transcripts
+(
+    file_unique_id TEXT        NOT NULL,
+    language       TEXT        NOT NULL,
+    text           TEXT        NOT NULL,
+    hits           INTEGER     NOT NULL DEFAULT 0,
+    created_at     TIMESTAMPTZ NOT NULL DEFAULT now(),
+    last_used_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (file_unique_id, language)
+);
+-- Age and size eviction both go by last use
+CREATE INDEX IF NOT EXISTS transcripts_last_used_at_idx ON transcripts (last_used_at);
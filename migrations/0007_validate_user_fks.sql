@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- Check the foreign keys 0002 added as NOT VALID. Each VALIDATE commits on its
+-- own and blocks neither reads nor writes of memory/feedback while it scans.
+ALTER TABLE memory VALIDATE CONSTRAINT memory_user_id_fkey;
+ALTER TABLE feedback VALIDATE CONSTRAINT feedback_user_id_fkey;
@@ -0,0 +1,7 @@
+-- Progress of storage_import.py per source file, committed with each batch
+CREATE TABLE IF NOT EXISTS import_checkpoints
+(
+    source     TEXT PRIMARY KEY,
+    users_done BIGINT      NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
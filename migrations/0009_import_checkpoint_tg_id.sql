@@ -0,0 +1,2 @@
+-- storage.log imports resume after the last imported tg_id, not after a position in the log
+ALTER TABLE import_checkpoints ADD COLUMN IF NOT EXISTS last_tg_id BIGINT;
@@ -0,0 +1,227 @@
+"""Rate limiting for everything the bot sends to Telegram.
+
+OutboundLimiter is an aiogram session middleware, so handlers keep calling
+message.answer / bot.send_message / edit_text as before:
+
+    bot.session.middleware(OutboundLimiter())
+
+Methods that post a message to a chat (send*, copy*, forward*, except
+sendChatAction) take a token from that chat's bucket (OUTBOUND_CHAT_RATE
+per second, OUTBOUND_GROUP_RATE for groups) and are sent one at a time in
+call order; Telegram's per-chat limit only counts these. Every other
+method aimed at a chat (edits, deleteMessage, sendChatAction, getChat...)
+takes only a token from the global bucket (OUTBOUND_GLOBAL_RATE per
+second), as do the messages. A 429 pauses the chat for retry_after
+seconds plus jitter and the call is retried, as are 5xx and network errors
+with exponential backoff, up to OUTBOUND_RETRIES times.
+
+Edits of the same message go out one at a time in call order, and those
+still waiting their turn are merged: only the newest text/markup is sent
+and every caller gets its result.
+
+With several processes sending for the same bot (supervisor.py) each
+takes 1/OUTBOUND_SHARE of the global rate.
+"""
+import asyncio
+import os
+import random
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import EditMessageCaption, EditMessageReplyMarkup, EditMessageText
+
+SHARE = int(os.getenv('OUTBOUND_SHARE', '1'))
+GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+GLOBAL_BURST = float(os.getenv('OUTBOUND_GLOBAL_BURST', '30'))
+CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', str(20 / 60)))
+CHAT_BURST = float(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+RETRIES = int(os.getenv('OUTBOUND_RETRIES', '5'))
+# Extra random delay after a 429, as a share of retry_after
+JITTER = float(os.getenv('OUTBOUND_JITTER', '0.2'))
+
+MERGEABLE = (EditMessageText, EditMessageReplyMarkup, EditMessageCaption)
+CHAT_LIMITED = ('send', 'copy', 'forward')
+
+
+class _Bucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        """Take a token if there is one; otherwise the seconds to wait before asking again."""
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return now >= self.blocked_until and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class _Chat:
+    __slots__ = ('bucket', 'lock', 'users')
+
+    def __init__(self, rate: float, burst: float):
+        self.bucket = _Bucket(rate, burst)
+        self.lock = asyncio.Lock()  # FIFO: calls to a chat go out in call order
+        self.users = 0
+
+
+class _MessageLock:
+    __slots__ = ('lock', 'users')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # FIFO: an older edit never lands after a newer one
+        self.users = 0
+
+
+class _PendingEdit:
+    __slots__ = ('method', 'future')
+
+    def __init__(self, method, future):
+        self.method = method
+        self.future = future
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = GLOBAL_RATE / SHARE, global_burst: float = GLOBAL_BURST / SHARE,
+                 chat_rate: float = CHAT_RATE, group_rate: float = GROUP_RATE, chat_burst: float = CHAT_BURST,
+                 retries: int = RETRIES):
+        self.global_bucket = _Bucket(global_rate, max(global_burst, 1))
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self._chats = {}
+        self._edits = {}  # (chat_id, message_id, method name) -> _PendingEdit not sent yet
+        self._edit_locks = {}  # same key -> _MessageLock, while edits of it are in flight
+        self._swept = time.monotonic()
+        self.stats = {'sent': 0, 'merged': 0, 'retry_after': 0, 'retried': 0, 'failed': 0, 'waited': 0.0}
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Not aimed at a chat (getUpdates, answerCallbackQuery, inline edits, ...)
+            return await self._request(make_request, bot, lambda: method, None)
+        if isinstance(method, MERGEABLE) and method.message_id is not None:
+            return await self._edit(make_request, bot, method)
+        if _posts_message(method):
+            return await self._to_chat(make_request, bot, chat_id, lambda: method)
+        return await self._request(make_request, bot, lambda: method, None, global_token=True)
+
+    async def _edit(self, make_request, bot, method):
+        key = (method.chat_id, method.message_id, type(method).__name__)
+        pending = self._edits.get(key)
+        if pending is not None:
+            # An older edit of this message is still waiting: send ours in its place
+            pending.method = method
+            self.stats['merged'] += 1
+            return await asyncio.shield(pending.future)
+        pending = self._edits[key] = _PendingEdit(method, asyncio.get_running_loop().create_future())
+
+        def latest():
+            # From here on newer edits queue up behind this one instead of merging into it
+            if self._edits.get(key) is pending:
+                del self._edits[key]
+            return pending.method
+
+        message = self._edit_locks.get(key)
+        if message is None:
+            message = self._edit_locks[key] = _MessageLock()
+        message.users += 1
+        try:
+            async with message.lock:
+                result = await self._request(make_request, bot, latest, None, global_token=True)
+        except BaseException as e:
+            if self._edits.get(key) is pending:
+                del self._edits[key]
+            if isinstance(e, asyncio.CancelledError):
+                pending.future.cancel()
+            elif not pending.future.done():
+                pending.future.set_exception(e)
+                pending.future.exception()  # mark as retrieved, there may be no merged callers
+            raise
+        finally:
+            message.users -= 1
+            if not message.users:
+                del self._edit_locks[key]
+        pending.future.set_result(result)
+        return result
+
+    async def _to_chat(self, make_request, bot, chat_id, method_at_send):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            group = isinstance(chat_id, str) or chat_id < 0
+            chat = self._chats[chat_id] = _Chat(self.group_rate if group else self.chat_rate, self.chat_burst)
+        chat.users += 1
+        try:
+            async with chat.lock:
+                return await self._request(make_request, bot, method_at_send, chat.bucket)
+        finally:
+            chat.users -= 1
+            if len(self._chats) > 1000 and time.monotonic() - self._swept > 60:
+                self._sweep()
+
+    async def _request(self, make_request, bot, method_at_send, bucket, global_token=None):
+        # A chat bucket always comes with a global token
+        global_token = bucket is not None if global_token is None else global_token
+        attempt = 0
+        while True:
+            if bucket is not None:
+                await self._take(bucket)
+            if global_token:
+                await self._take(self.global_bucket)
+            try:
+                response = await make_request(bot, method_at_send())
+                self.stats['sent'] += 1
+                return response
+            except TelegramRetryAfter as e:
+                self.stats['retry_after'] += 1
+                if attempt >= self.retries:
+                    self.stats['failed'] += 1
+                    raise
+                pause = e.retry_after * (1 + random.uniform(0, JITTER))
+                if bucket is not None:
+                    bucket.blocked_until = time.monotonic() + pause
+                else:
+                    await asyncio.sleep(pause)
+            except (TelegramServerError, TelegramNetworkError):
+                if attempt >= self.retries:
+                    self.stats['failed'] += 1
+                    raise
+                await asyncio.sleep(min(2 ** attempt, 30) * random.uniform(0.5, 1.5))
+            attempt += 1
+            self.stats['retried'] += 1
+
+    async def _take(self, bucket):
+        while True:
+            wait = bucket.delay()
+            if not wait:
+                return
+            self.stats['waited'] += wait
+            await asyncio.sleep(wait)
+
+    def _sweep(self):
+        # Forget chats nobody is sending to whose bucket has refilled anyway
+        self._swept = time.monotonic()
+        for chat_id in [c for c, chat in self._chats.items() if not chat.users and chat.bucket.idle()]:
+            del self._chats[chat_id]
+
+
+def _posts_message(method) -> bool:
+    name = method.__api_method__
+    return name.startswith(CHAT_LIMITED) and name != 'sendChatAction'
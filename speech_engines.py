@@ -0,0 +1,236 @@
+"""Speech recognition engines, picked with SPEECH_ENGINE.
+
+    google   Google Web Speech API through SpeechRecognition (default, needs network)
+    vosk     offline Kaldi models on the CPU: pip install vosk, model directory in VOSK_MODEL_PATH
+    whisper  offline Whisper on the CPU: pip install faster-whisper, size in WHISPER_MODEL
+    stub     deterministic text derived from the audio, for load tests
+
+recognize(audio, language) is what the bots run in the transcription pool;
+it returns the text and the name of the engine that produced it. Offline
+models are loaded once per process on first use. If the engine fails with
+a network error or times out (SPEECH_TIMEOUT seconds) and SPEECH_FALLBACK
+names another engine, that one answers instead, so a slow external API
+does not stop transcription. Transcripts are cached under the engine that
+actually made them (cache_key), so a fallback text is never served as if
+SPEECH_ENGINE had produced it.
+
+Compare engines on the same recordings:
+
+    python speech_engines.py voice1.ogg voice2.ogg --engines google,vosk,stub --concurrency 4
+"""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+import speech_recognition as sr
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ENGINE = os.getenv('SPEECH_ENGINE', 'google')
+FALLBACK = os.getenv('SPEECH_FALLBACK', '')
+TIMEOUT = float(os.getenv('SPEECH_TIMEOUT', '15'))
+VOSK_MODEL_PATH = os.getenv('VOSK_MODEL_PATH', 'model')
+WHISPER_MODEL = os.getenv('WHISPER_MODEL', 'base')
+WHISPER_COMPUTE_TYPE = os.getenv('WHISPER_COMPUTE_TYPE', 'int8')
+WHISPER_THREADS = int(os.getenv('WHISPER_THREADS', '0'))  # 0: let CTranslate2 decide
+WHISPER_BEAM_SIZE = int(os.getenv('WHISPER_BEAM_SIZE', '1'))
+# Simulated recognition time: a fixed part plus a share of the audio length
+STUB_DELAY = float(os.getenv('SPEECH_STUB_DELAY', '0'))
+STUB_RTF = float(os.getenv('SPEECH_STUB_RTF', '0'))
+
+SAMPLE_RATE = 16000
+
+
+class GoogleEngine:
+    name = 'google'
+
+    def recognize(self, audio: sr.AudioData, language: str) -> str:
+        r = sr.Recognizer()
+        r.operation_timeout = TIMEOUT
+        return r.recognize_google(audio, language=language)
+
+
+class VoskEngine:
+    name = 'vosk'
+
+    def __init__(self, model_path: str = VOSK_MODEL_PATH):
+        try:
+            import vosk
+        except ImportError:
+            raise RuntimeError('SPEECH_ENGINE=vosk needs the vosk package (pip install vosk)') from None
+        if not os.path.isdir(model_path):
+            raise RuntimeError(f'No Vosk model in {model_path!r}, download one from '
+                               f'https://alphacephei.com/vosk/models and set VOSK_MODEL_PATH')
+        vosk.SetLogLevel(-1)
+        self._vosk = vosk
+        self.model = vosk.Model(model_path)  # shared by all threads, recognizers are per call
+
+    def recognize(self, audio: sr.AudioData, language: str) -> str:
+        # The model decides the language
+        recognizer = self._vosk.KaldiRecognizer(self.model, SAMPLE_RATE)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2))
+        text = json.loads(recognizer.FinalResult()).get('text', '')
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class WhisperEngine:
+    name = 'whisper'
+
+    def __init__(self, model: str = WHISPER_MODEL):
+        try:
+            import numpy
+            from faster_whisper import WhisperModel
+        except ImportError:
+            raise RuntimeError('SPEECH_ENGINE=whisper needs faster-whisper (pip install faster-whisper)') from None
+        import transcription_pool
+
+        self._numpy = numpy
+        self.model = WhisperModel(model, device='cpu', compute_type=WHISPER_COMPUTE_TYPE,
+                                  cpu_threads=WHISPER_THREADS, num_workers=transcription_pool.WORKERS)
+
+    def recognize(self, audio: sr.AudioData, language: str) -> str:
+        np = self._numpy
+        pcm = np.frombuffer(audio.get_raw_data(convert_rate=SAMPLE_RATE, convert_width=2), np.int16)
+        segments, _ = self.model.transcribe(pcm.astype(np.float32) / 32768, language=language.split('-')[0],
+                                            beam_size=WHISPER_BEAM_SIZE)
+        text = ' '.join(segment.text.strip() for segment in segments).strip()
+        if not text:
+            raise sr.UnknownValueError()
+        return text
+
+
+class StubEngine:
+    name = 'stub'
+
+    def recognize(self, audio: sr.AudioData, language: str) -> str:
+        data = audio.frame_data
+        if not data:
+            raise sr.UnknownValueError()
+        seconds = len(data) / (audio.sample_rate * audio.sample_width)
+        if STUB_DELAY or STUB_RTF:
+            time.sleep(STUB_DELAY + seconds * STUB_RTF)
+        return f'[{language}] {seconds:.1f} с, {hashlib.sha1(data).hexdigest()[:8]}'
+
+
+ENGINES = {engine.name: engine for engine in (GoogleEngine, VoskEngine, WhisperEngine, StubEngine)}
+
+_loaded = {}
+_lock = threading.Lock()
+_stats = {'fallbacks': 0}
+
+
+def get_engine(name: str = ENGINE):
+    engine = _loaded.get(name)
+    if engine is None:
+        if name not in ENGINES:
+            raise ValueError(f'Unknown speech engine {name!r}, expected one of {", ".join(ENGINES)}')
+        with _lock:  # load a model once even if several workers ask at the same time
+            engine = _loaded.get(name)
+            if engine is None:
+                engine = _loaded[name] = ENGINES[name]()
+    return engine
+
+
+def recognize_with(name: str, audio: sr.AudioData, language: str) -> tuple:
+    """(text, name) from the named engine."""
+    return get_engine(name).recognize(audio, language), name
+
+
+def recognize(audio: sr.AudioData, language: str) -> tuple:
+    """(text, engine): SPEECH_ENGINE, or SPEECH_FALLBACK when it cannot be reached."""
+    try:
+        return recognize_with(ENGINE, audio, language)
+    except (sr.RequestError, OSError) as e:  # URLError and socket timeouts are OSErrors
+        if not FALLBACK or FALLBACK == ENGINE:
+            raise
+        _stats['fallbacks'] += 1
+        print(f'{ENGINE} recognition failed ({e}), using {FALLBACK}')
+        return recognize_with(FALLBACK, audio, language)
+
+
+def cache_key(language: str, engine: str = ENGINE) -> str:
+    """Language key for transcript_cache: engines give different texts for the same note."""
+    # google keeps the plain key so transcripts cached before engines existed stay valid
+    return language if engine == 'google' else f'{language}:{engine}'
+
+
+def stats() -> dict:
+    return {**_stats, 'engine': ENGINE, 'fallback': FALLBACK or None, 'loaded': list(_loaded)}
+
+
+# ======== Benchmark ========
+
+async def benchmark(args) -> None:
+    import asyncio
+    import functools
+    import statistics
+
+    import transcription_pool
+    import voice_pipeline
+
+    recordings = []
+    for path in args.files:
+        with open(path, 'rb') as f:
+            audio = await voice_pipeline.decode(f)
+        recordings.append(audio)
+    audio_seconds = sum(len(a.frame_data) / (a.sample_rate * a.sample_width) for a in recordings) * args.repeat
+    print(f'{len(recordings)} recordings, {audio_seconds / args.repeat:.1f} s of audio, '
+          f'{args.repeat} rounds, concurrency {args.concurrency}')
+
+    for name in args.engines.split(','):
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(get_engine, name)
+        except Exception as e:
+            print(f'{name:8} unavailable: {e}')
+            continue
+        load_time = time.perf_counter() - started
+
+        transcription_pool.pool = transcription_pool.TranscriptionPool(
+            workers=args.concurrency, queue_size=sys.maxsize, executor='thread')
+        recognize_one = functools.partial(recognize_with, name)
+        latencies = []
+        failures = 0
+
+        async def one(audio):
+            nonlocal failures
+            t = time.perf_counter()
+            try:
+                await voice_pipeline.transcribe(audio, recognize_one, args.language)
+            except Exception:
+                failures += 1
+            else:
+                latencies.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(audio) for audio in recordings * args.repeat))
+        wall = time.perf_counter() - started
+        transcription_pool.pool.shutdown()
+
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            print(f'{name:8} load={load_time:.2f}s ok={len(latencies)} failed={failures} '
+                  f'p50={statistics.median(latencies):.2f}s p95={p95:.2f}s max={latencies[-1]:.2f}s '
+                  f'throughput={len(latencies) / wall:.2f} req/s, {audio_seconds / wall:.1f} audio s/s')
+        else:
+            print(f'{name:8} load={load_time:.2f}s all {failures} requests failed')
+
+
+if __name__ == '__main__':
+    import argparse
+    import asyncio
+
+    parser = argparse.ArgumentParser(description='Compare speech engines on latency and throughput')
+    parser.add_argument('files', nargs='+', help='recordings in any format ffmpeg reads')
+    parser.add_argument('--engines', default=','.join(ENGINES))
+    parser.add_argument('--language', default='ru-RU')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    asyncio.run(benchmark(parser.parse_args()))
@@ -0,0 +1,36 @@
+"""Selects the module that implements the storage API.
+
+STORAGE_BACKEND=postgres (default) uses db.py, STORAGE_BACKEND=sqlite uses
+the embedded db_sqlite.py. A backend is a module with every function in
+API, taking the same arguments and returning the same values as db.py.
+db_async serves the embedded backends by running these functions in a
+worker thread.
+"""
+import importlib
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BACKENDS = {'postgres': 'db', 'sqlite': 'db_sqlite'}
+API = ('get_user', 'remember', 'recall', 'recall_page', 'search_memory', 'forget', 'forget_ids',
+       'forget_name', 'reserve_voice_slot', 'release_voice_slot', 'create_feedback', 'get_feedback',
+       'delete_feedback')
+
+NAME = os.getenv('STORAGE_BACKEND', 'postgres').lower()
+
+
+def embedded() -> bool:
+    """True when the backend runs in-process (no Postgres server, no LISTEN/NOTIFY)."""
+    return NAME != 'postgres'
+
+
+def load(name: str = NAME):
+    if name not in BACKENDS:
+        raise ValueError(f'unknown STORAGE_BACKEND {name!r}, expected one of {", ".join(BACKENDS)}')
+    module = importlib.import_module(BACKENDS[name])
+    missing = [func for func in API if not callable(getattr(module, func, None))]
+    if missing:
+        raise TypeError(f'{module.__name__} does not implement {", ".join(missing)}')
+    return module
@@ -0,0 +1,310 @@
+"""Bulk import/export between memory.py's storage files and Postgres.
+
+    python storage_import.py import [--file storage.log] [--batch 5000] [--restart]
+    python storage_import.py export [--file export.json]
+
+Import reads memory.py's storage.log (replayed with memory.LogStore, so
+only the latest value of every field is imported) or, for a file ending
+in .json, the legacy storage.json, streamed with an incremental parser so
+only one user object is held in memory at a time. Without --file it takes
+storage.log if it exists and storage.json otherwise. Users are upserted
+with execute_values and memory rows loaded with COPY, one transaction per
+batch. Progress is saved in the import_checkpoints table (migrations 0008
+and 0009) in the same transaction as the batch, so an interrupted import
+resumes exactly where it stopped. storage.log users are imported in tg_id
+order and resume after the last imported tg_id, so users deleted or
+re-added in the meantime do not shift the checkpoint; a user added since
+then with a lower tg_id is not picked up. storage.json is resumed by
+position and must not change between runs.
+
+Field mapping: name -> users.name, voice_week_start_ts -> users.voice_time,
+voice_counter -> users.voice_counter, beta -> users.beta; any other field
+becomes a memory row "<field>: <value>" (a list under "memory" becomes one
+row per item, which is what export writes).
+"""
+import argparse
+import codecs
+import io
+import itertools
+import json
+import os
+import sys
+import time
+
+from psycopg2.extras import execute_values
+
+import cache_sync
+import memory
+import user_cache
+from db import connect_db
+from migrations import migrate
+
+USER_COLUMNS = {'name': 'name', 'voice_week_start_ts': 'voice_time',
+                'voice_counter': 'voice_counter', 'beta': 'beta'}
+CHUNK = 64 * 1024
+
+
+class _Stream:
+    """Incremental decoder for a top-level {"key": value, ...} JSON object."""
+
+    def __init__(self, f):
+        self._f = f
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self.bytes_read = 0
+
+    def _more(self) -> bool:
+        raw = self._f.read(CHUNK)
+        self.bytes_read += len(raw)
+        self._buf = self._buf[self._pos:] + self._decoder.decode(raw, final=not raw)
+        self._pos = 0
+        return bool(raw)
+
+    def _skip(self, chars=' \t\r\n'):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in chars:
+                self._pos += 1
+            if self._pos < len(self._buf) or not self._more():
+                return
+
+    def _expect(self, char):
+        self._skip()
+        if self._buf[self._pos:self._pos + 1] != char:
+            raise ValueError(f'expected {char!r} at byte ~{self.bytes_read}')
+        self._pos += 1
+
+    def _value(self):
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # A number at the very end of the buffer may continue in the next chunk
+            if end == len(self._buf) and self._more():
+                continue
+            self._pos = end
+            return value
+
+    def items(self):
+        self._expect('{')
+        self._skip()
+        if self._buf[self._pos:self._pos + 1] == '}':
+            return
+        while True:
+            self._skip()
+            key = self._value()
+            self._expect(':')
+            self._skip()
+            yield key, self._value()
+            self._skip()
+            sep = self._buf[self._pos:self._pos + 1]
+            self._pos += 1
+            if sep == '}':
+                return
+            if sep != ',':
+                raise ValueError(f'expected "," or "}}" at byte ~{self.bytes_read}')
+
+
+def _copy_text(value: str) -> str:
+    # Escaping for COPY ... FROM STDIN in text format
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _split(tg_id: int, fields: dict):
+    user = {'tg_id': tg_id, 'name': None, 'voice_time': None, 'voice_counter': None, 'beta': None}
+    rows = []
+    for field, value in fields.items():
+        if field in USER_COLUMNS:
+            user[USER_COLUMNS[field]] = str(value) if field in ('name', 'beta') else value
+        elif field == 'memory' and isinstance(value, list):
+            rows.extend(str(item) for item in value)
+        else:
+            rows.append(f'{field}: {value}')
+    return user, rows
+
+
+def _log_items(path: str, after: int = None):
+    """(user, fields) for live users in a storage.log past tg_id `after`, plus a progress callable."""
+    # No legacy seed: a missing log must not be created from a storage.json
+    store = memory.LogStore(path, legacy_path=path + '.no-legacy')
+    # Sorted: log order changes when a user is deleted and written again
+    users = sorted((user for user in store.users() if after is None or int(user) > after), key=int)
+    done = 0
+
+    def items():
+        nonlocal done
+        try:
+            for user in users:
+                done += 1
+                yield user, store.get(user)
+        finally:
+            store.close()
+
+    return items(), lambda: (done, len(users))
+
+
+def _json_items(f, skip: int = 0):
+    stream = _Stream(f)
+    return itertools.islice(stream.items(), skip, None), lambda: (stream.bytes_read, os.fstat(f.fileno()).st_size)
+
+
+def _default_file() -> str:
+    return memory.LOG_PATH if os.path.exists(memory.LOG_PATH) else memory.LEGACY_PATH
+
+
+def _ensure_tables(cur):
+    cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS import_memory
+                (
+                    tg_id BIGINT,
+                    data  TEXT
+                ) ON COMMIT DELETE ROWS;
+                """)
+
+
+def _load_batch(cur, users, memory_rows):
+    execute_values(cur, """
+        INSERT INTO users (tg_id, name, voice_time, voice_counter, beta)
+        VALUES %s
+        ON CONFLICT (tg_id) DO UPDATE
+            SET name          = COALESCE(EXCLUDED.name, users.name),
+                voice_time    = COALESCE(EXCLUDED.voice_time, users.voice_time),
+                voice_counter = COALESCE(EXCLUDED.voice_counter, users.voice_counter),
+                beta          = COALESCE(EXCLUDED.beta, users.beta)
+        """, [(u['tg_id'], u['name'], u['voice_time'], u['voice_counter'], u['beta']) for u in users],
+                   page_size=1000)
+    if memory_rows:
+        buf = io.StringIO(''.join(f'{tg_id}\t{_copy_text(data)}\n' for tg_id, data in memory_rows))
+        cur.copy_expert('COPY import_memory (tg_id, data) FROM STDIN', buf)
+        cur.execute("""
+                    INSERT INTO memory (user_id, data)
+                    SELECT users.id, import_memory.data
+                    FROM import_memory
+                             JOIN users ON users.tg_id = import_memory.tg_id
+                    """)
+    # Running bots drop their cached rows for the imported users (see cache_sync)
+    execute_values(cur, 'SELECT pg_notify(v.channel, v.payload) FROM (VALUES %s) AS v (channel, payload)',
+                   [(cache_sync.CHANNEL, cache_sync.payload('users', u['tg_id'])) for u in users], page_size=1000)
+
+
+def import_storage(path: str, batch: int = 5000, restart: bool = False) -> int:
+    source = os.path.abspath(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(path)
+    migrate()
+    cur, con = connect_db()
+    try:
+        _ensure_tables(cur)
+        if restart:
+            cur.execute('DELETE FROM import_checkpoints WHERE source = %s', (source,))
+        cur.execute('SELECT users_done, last_tg_id FROM import_checkpoints WHERE source = %s', (source,))
+        row = cur.fetchone()
+        con.commit()
+        skip, last = row if row else (0, None)
+        if skip:
+            print(f'Resuming after {skip} users')
+
+        done = skip
+        users, memory_rows = [], []
+        started = time.monotonic()
+        with open(path, 'rb') as f:
+            items, position = _json_items(f, skip) if path.endswith('.json') else _log_items(path, last)
+            for key, fields in items:
+                done += 1
+                user, entries = _split(int(key), fields or {})
+                users.append(user)
+                memory_rows.extend((user['tg_id'], data) for data in entries)
+                if len(users) >= batch:
+                    _commit(cur, con, source, done, users, memory_rows)
+                    _progress(done, skip, position(), started)
+                    users, memory_rows = [], []
+            if users:
+                _commit(cur, con, source, done, users, memory_rows)
+            _progress(done, skip, position(), started)
+    finally:
+        con.close()
+    user_cache.clear()
+    print()
+    return done
+
+
+def _commit(cur, con, source, done, users, memory_rows):
+    try:
+        _load_batch(cur, users, memory_rows)
+        cur.execute("""
+                    INSERT INTO import_checkpoints (source, users_done, last_tg_id)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (source) DO UPDATE SET users_done = EXCLUDED.users_done,
+                                                       last_tg_id = EXCLUDED.last_tg_id,
+                                                       updated_at = now()
+                    """, (source, done, users[-1]['tg_id']))
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+
+
+def _progress(done, skip, position, started):
+    read, total = position
+    rate = (done - skip) / max(time.monotonic() - started, 1e-9)
+    percent = 100 * read / total if total else 100
+    print(f'\r{done} users, {percent:5.1f}% of file, {rate:,.0f} users/s', end='', file=sys.stderr, flush=True)
+
+
+def export_json(path: str) -> int:
+    """Stream users and their memory back out in storage.json format."""
+    cur, con = connect_db()
+    exported = 0
+    try:
+        rows = con.cursor(name='export_users')
+        rows.itersize = 5000
+        rows.execute("""
+                     SELECT users.tg_id, users.name, users.voice_time, users.voice_counter, users.beta, memory.data
+                     FROM users
+                              LEFT JOIN memory ON memory.user_id = users.id
+                     ORDER BY users.id, memory.id
+                     """)
+        with open(path, 'w', encoding='utf-8') as out:
+            out.write('{')
+            current, entry = None, None
+            for tg_id, name, voice_time, voice_counter, beta, data in rows:
+                if tg_id != current:
+                    if entry is not None:
+                        out.write((',' if exported else '') + f'\n  {json.dumps(str(current))}: '
+                                  + json.dumps(entry, ensure_ascii=False))
+                        exported += 1
+                    current = tg_id
+                    entry = {k: v for k, v in (('name', name), ('voice_week_start_ts', voice_time),
+                                               ('voice_counter', voice_counter), ('beta', beta)) if v is not None}
+                if data is not None:
+                    entry.setdefault('memory', []).append(data)
+            if entry is not None:
+                out.write((',' if exported else '') + f'\n  {json.dumps(str(current))}: '
+                          + json.dumps(entry, ensure_ascii=False))
+                exported += 1
+            out.write('\n}\n')
+        rows.close()
+        con.commit()
+    finally:
+        con.close()
+    return exported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import')
+    imp.add_argument('--file', default=None, help='storage.log or storage.json (default: whichever exists)')
+    imp.add_argument('--batch', type=int, default=5000)
+    imp.add_argument('--restart', action='store_true', help='ignore the saved checkpoint')
+    exp = sub.add_parser('export')
+    exp.add_argument('--file', default='export.json')
+    args = parser.parse_args()
+    if args.command == 'import':
+        print(f'Imported {import_storage(args.file or _default_file(), args.batch, args.restart)} users')
+    else:
+        print(f'Exported {export_json(args.file)} users')
@@ -0,0 +1,302 @@
+"""Multi-process mode: one process polls Telegram, N workers handle updates.
+
+    python bot.py --workers 4        (or BOT_WORKERS=4)
+
+The supervisor long-polls getUpdates and puts every update on the queue
+of worker from_user.id % N (the chat id when there is no user), so one
+user's updates always reach the same worker in order, where the update
+scheduler keeps them ordered, while CPU-heavy handlers of different users
+run on different cores.
+
+Workers send a heartbeat every HEARTBEAT_INTERVAL seconds. A worker that
+exits or misses heartbeats for HEARTBEAT_TIMEOUT seconds is restarted.
+SIGHUP restarts all workers one at a time: the old worker stops taking
+updates, finishes what it has (up to DRAIN_TIMEOUT seconds) and exits
+before its replacement starts on the same queue, so nothing is lost or
+reordered. A worker that has to be killed may die inside updates.get()
+holding the queue's reader lock, so its replacement gets a new queue and
+the updates still waiting on the old one are dropped. A status line per
+worker is printed every REPORT_INTERVAL seconds and served as JSON on
+http://HEALTH_HOST:SUPERVISOR_HEALTH_PORT/healthz when that port is set.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', '5'))
+HEARTBEAT_TIMEOUT = float(os.getenv('WORKER_HEARTBEAT_TIMEOUT', '30'))
+DRAIN_TIMEOUT = float(os.getenv('WORKER_DRAIN_TIMEOUT', '30'))
+REPORT_INTERVAL = float(os.getenv('SUPERVISOR_REPORT_INTERVAL', '60'))
+HEALTH_HOST = os.getenv('SUPERVISOR_HEALTH_HOST', '127.0.0.1')
+HEALTH_PORT = int(os.getenv('SUPERVISOR_HEALTH_PORT', '0'))
+POLL_TIMEOUT = 30
+
+_STOP = None
+_mp = multiprocessing.get_context('spawn')
+
+
+# ======== Worker process ========
+
+def _worker_main(index: int, updates, status) -> None:
+    # Ctrl+C reaches the whole process group; the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        asyncio.run(_worker(index, updates, status))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _worker(index: int, updates, status) -> None:
+    import bot as app  # imported in the child only: handlers, db pools, ...
+
+    loop = asyncio.get_running_loop()
+    tasks = set()
+    handled = 0
+
+    async with app.running_bot() as bot:
+        dp, scheduler = app.build_dispatcher()
+
+        def report():
+            status.put({'worker': index, 'pid': os.getpid(), 'ts': time.time(), 'handled': handled,
+                        'in_flight': len(tasks), 'scheduler': scheduler.stats(),
+                        'transcription': app.transcription_pool.pool.snapshot()})
+
+        async def heartbeat():
+            while True:
+                report()
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+        async def handle(raw):
+            nonlocal handled
+            try:
+                await dp.feed_raw_update(bot, json.loads(raw))
+            except Exception as e:
+                print(f'worker {index}: update failed: {e}')
+            finally:
+                handled += 1
+
+        beat = asyncio.create_task(heartbeat())
+        try:
+            while True:
+                raw = await loop.run_in_executor(None, updates.get)
+                if raw is _STOP:
+                    break
+                task = asyncio.create_task(handle(raw))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+        finally:
+            beat.cancel()
+            report()
+
+
+# ======== Supervisor ========
+
+class _Worker:
+    def __init__(self, index: int, status):
+        self.index = index
+        self.status = status
+        self.updates = _mp.Queue()
+        self.process = None
+        self.health = {}
+        self.restarts = 0
+
+    def start(self):
+        self.process = _mp.Process(target=_worker_main, args=(self.index, self.updates, self.status),
+                                   name=f'muziatik-worker-{self.index}', daemon=False)
+        self.process.start()
+        self.health = {'worker': self.index, 'pid': self.process.pid, 'ts': time.time()}
+
+    async def stop(self):
+        """Let the worker finish its queue and in-flight updates, then wait for it to exit."""
+        self.updates.put(_STOP)
+        await asyncio.to_thread(self.process.join, DRAIN_TIMEOUT + HEARTBEAT_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.replace_queue()
+            await asyncio.to_thread(self.process.join)
+
+    def replace_queue(self):
+        """New queue for the next process: a killed one never releases the old queue's reader lock."""
+        old, self.updates = self.updates, _mp.Queue()
+        dropped = self.updates_left(old)
+        if dropped:
+            print(f'Worker {self.index}: dropped {dropped} queued updates')
+        old.cancel_join_thread()  # nobody reads it any more, do not wait for the pipe to drain
+        old.close()
+
+    @staticmethod
+    def updates_left(updates):
+        try:
+            return updates.qsize()
+        except NotImplementedError:  # macOS
+            return None
+
+    async def restart(self):
+        await self.stop()
+        self.restarts += 1
+        self.start()
+
+    def snapshot(self) -> dict:
+        return {**self.health, 'alive': self.process.is_alive(), 'queued': self.updates_left(self.updates),
+                'restarts': self.restarts, 'heartbeat_age': round(time.time() - self.health.get('ts', 0), 1)}
+
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.status = _mp.Queue()
+        self.workers = [_Worker(i, self.status) for i in range(workers)]
+        self.stats = {'updates': 0, 'rolling_restarts': 0, 'crash_restarts': 0}
+        self._stopping = asyncio.Event()
+        self._restarting = False
+
+    def shard(self, update) -> int:
+        try:
+            event = update.event
+        except Exception:  # update type this aiogram does not know
+            return update.update_id % len(self.workers)
+        user = getattr(event, 'from_user', None)
+        chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+        key = user.id if user else chat.id if chat else update.update_id
+        return key % len(self.workers)
+
+    async def run(self, bot) -> None:
+        loop = asyncio.get_running_loop()
+        for sig, handler in ((signal.SIGINT, self._stopping.set), (signal.SIGTERM, self._stopping.set),
+                             (signal.SIGHUP, lambda: loop.create_task(self.rolling_restart()))):
+            loop.add_signal_handler(sig, handler)
+        for worker in self.workers:
+            worker.start()
+        print(f'Supervisor is live with {len(self.workers)} workers')
+        background = [asyncio.create_task(self._collect_status()), asyncio.create_task(self._watch()),
+                      asyncio.create_task(self._report())]
+        if HEALTH_PORT:
+            background.append(asyncio.create_task(self._serve_health()))
+        poller = asyncio.create_task(self._poll(bot))
+        try:
+            await self._stopping.wait()
+        finally:
+            poller.cancel()
+            for task in background:
+                task.cancel()
+            await asyncio.gather(*(worker.stop() for worker in self.workers))
+            print(f'Supervisor stopped: {self.stats}')
+
+    async def rolling_restart(self) -> None:
+        if self._restarting:
+            return
+        self._restarting = True
+        try:
+            for worker in self.workers:
+                if self._stopping.is_set():
+                    break
+                print(f'Restarting worker {worker.index}')
+                await worker.restart()
+            self.stats['rolling_restarts'] += 1
+        finally:
+            self._restarting = False
+
+    def health(self) -> dict:
+        return {**self.stats, 'workers': [worker.snapshot() for worker in self.workers]}
+
+    async def _poll(self, bot) -> None:
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+            except Exception as e:
+                print(f'getUpdates failed: {e}')
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                raw = update.model_dump_json(by_alias=True, exclude_none=True)
+                self.workers[self.shard(update)].updates.put(raw)
+                offset = update.update_id + 1
+                self.stats['updates'] += 1
+
+    async def _collect_status(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                health = await loop.run_in_executor(None, self.status.get, True, 1)
+            except queue.Empty:
+                continue
+            worker = self.workers[health['worker']]
+            if health['pid'] == worker.process.pid:
+                worker.health = health
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if self._restarting:
+                continue
+            for worker in self.workers:
+                if not worker.process.is_alive():
+                    print(f'Worker {worker.index} exited with {worker.process.exitcode}, restarting')
+                elif time.time() - worker.health.get('ts', 0) > HEARTBEAT_TIMEOUT:
+                    print(f'Worker {worker.index} missed heartbeats, restarting')
+                    worker.process.kill()
+                else:
+                    continue
+                # It did not get _STOP, so it may have died holding the queue's reader lock
+                worker.replace_queue()
+                await asyncio.to_thread(worker.process.join)
+                worker.restarts += 1
+                self.stats['crash_restarts'] += 1
+                worker.start()
+
+    async def _report(self) -> None:
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            for snapshot in self.health()['workers']:
+                scheduler = snapshot.get('scheduler', {})
+                print(f"worker {snapshot['worker']} pid={snapshot.get('pid')} alive={snapshot['alive']} "
+                      f"queued={snapshot['queued']} in_flight={snapshot.get('in_flight')} "
+                      f"handled={snapshot.get('handled')} wait_max={scheduler.get('wait_max', 0):.3f}s "
+                      f"heartbeat_age={snapshot['heartbeat_age']}s restarts={snapshot['restarts']}")
+
+    async def _serve_health(self) -> None:
+        from aiohttp import web
+
+        async def healthz(request):
+            health = self.health()
+            ok = all(w['alive'] and w['heartbeat_age'] <= HEARTBEAT_TIMEOUT for w in health['workers'])
+            return web.json_response(health, status=200 if ok else 503)
+
+        app = web.Application()
+        app.router.add_get('/healthz', healthz)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, HEALTH_HOST, HEALTH_PORT).start()
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+
+async def run(workers: int) -> None:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    session = AiohttpSession()
+    if os.getenv('TELEGRAM_API_URL'):
+        session.api = TelegramAPIServer.from_base(os.getenv('TELEGRAM_API_URL'))
+    bot = Bot(token=os.getenv('API_TOKEN_muziatikBot'), session=session)
+    # Spawned workers inherit this: each one sends at 1/N of the global rate
+    os.environ.setdefault('OUTBOUND_SHARE', str(workers))
+    try:
+        # Workers get updates from us, not from a webhook
+        await bot.delete_webhook()
+        await Supervisor(workers).run(bot)
+    finally:
+        await bot.session.close()
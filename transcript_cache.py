@@ -0,0 +1,125 @@
+"""Cache of finished transcriptions, keyed by (file_unique_id, language).
+
+file_unique_id is the same for every copy of a voice note, so a forwarded
+note is answered from here without downloading, recognizing or charging
+quota again. Lookups check a per-process LRU (TRANSCRIPT_CACHE_SIZE
+entries) and then the transcripts table (migration 0006), which is shared
+by all processes and survives restarts.
+
+Rows unused for TRANSCRIPT_CACHE_MAX_AGE_DAYS are deleted, and the table is
+trimmed to the TRANSCRIPT_CACHE_MAX_ROWS most recently used, at most once
+per TRANSCRIPT_CACHE_PRUNE_INTERVAL seconds. With an embedded
+STORAGE_BACKEND, or TRANSCRIPT_CACHE_PERSIST=0, only the LRU is used.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+import db_async
+import storage_backend
+
+load_dotenv()
+
+CACHE_SIZE = int(os.getenv('TRANSCRIPT_CACHE_SIZE', '1000'))
+PERSIST = (os.getenv('TRANSCRIPT_CACHE_PERSIST', '1') not in ('', '0', 'false', 'False')
+           and not storage_backend.embedded())
+MAX_AGE_DAYS = int(os.getenv('TRANSCRIPT_CACHE_MAX_AGE_DAYS', '90'))
+MAX_ROWS = int(os.getenv('TRANSCRIPT_CACHE_MAX_ROWS', '100000'))
+PRUNE_INTERVAL = float(os.getenv('TRANSCRIPT_CACHE_PRUNE_INTERVAL', '3600'))
+
+_entries = OrderedDict()  # (file_unique_id, language) -> text
+_lock = threading.Lock()
+_stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stored': 0, 'pruned': 0, 'errors': 0}
+_last_prune = 0.0
+
+
+async def get(file_unique_id: str, language: str):
+    """Cached transcript or None."""
+    key = (file_unique_id, language)
+    with _lock:
+        text = _entries.get(key)
+        if text is not None:
+            _entries.move_to_end(key)
+            _stats['memory_hits'] += 1
+            return text
+    if PERSIST:
+        try:
+            pool = await db_async.get_pool()
+            text = await pool.fetchval(
+                """
+                UPDATE transcripts
+                SET hits         = hits + 1,
+                    last_used_at = now()
+                WHERE file_unique_id = $1
+                  AND language = $2
+                RETURNING text
+                """,
+                file_unique_id, language)
+        except Exception as e:
+            # The cache must never break transcription
+            _stats['errors'] += 1
+            print(f'transcript cache read failed: {e}')
+            text = None
+        if text is not None:
+            _stats['db_hits'] += 1
+            _remember(key, text)
+            return text
+    _stats['misses'] += 1
+    return None
+
+
+async def put(file_unique_id: str, language: str, text: str) -> None:
+    _remember((file_unique_id, language), text)
+    _stats['stored'] += 1
+    if not PERSIST:
+        return
+    try:
+        pool = await db_async.get_pool()
+        await pool.execute(
+            """
+            INSERT INTO transcripts (file_unique_id, language, text)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (file_unique_id, language) DO UPDATE SET text         = EXCLUDED.text,
+                                                                 last_used_at = now()
+            """,
+            file_unique_id, language, text)
+        await _prune(pool)
+    except Exception as e:
+        _stats['errors'] += 1
+        print(f'transcript cache write failed: {e}')
+
+
+def stats() -> dict:
+    with _lock:
+        return {**_stats, 'size': len(_entries), 'persist': PERSIST}
+
+
+def _remember(key, text):
+    with _lock:
+        _entries[key] = text
+        _entries.move_to_end(key)
+        while len(_entries) > CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+async def _prune(pool) -> None:
+    global _last_prune
+    now = time.monotonic()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    status = await pool.execute(
+        """
+        DELETE
+        FROM transcripts
+        WHERE last_used_at < now() - make_interval(days => $1)
+           OR (file_unique_id, language) IN (SELECT file_unique_id, language
+                                             FROM transcripts
+                                             ORDER BY last_used_at DESC
+                                             OFFSET $2)
+        """,
+        MAX_AGE_DAYS, MAX_ROWS)
+    _stats['pruned'] += int(status.split()[-1])
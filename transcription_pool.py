@@ -0,0 +1,143 @@
+"""Dedicated, bounded executor for speech recognition.
+
+Recognition used to share asyncio's default thread pool with every other
+to_thread call. Here it gets TRANSCRIBE_WORKERS workers of its own
+(threads, or processes with TRANSCRIBE_EXECUTOR=process) and at most
+TRANSCRIBE_QUEUE jobs may wait for one; beyond that run() raises QueueFull
+straight away, and handlers can check full() before downloading anything.
+
+A job made of several runs (the chunks of one voice note) calls admit()
+once, which raises QueueFull if a new job would be refused, and then
+passes admitted=True to each run(), which is never refused, so the job is
+accepted or refused as a whole.
+
+Waiting jobs are served in order. on_position(n) is called with the job's
+place in the queue when it starts waiting and every time it moves up, so
+the handler can show it to the user.
+"""
+import asyncio
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+WORKERS = int(os.getenv('TRANSCRIBE_WORKERS', '4'))
+QUEUE_SIZE = int(os.getenv('TRANSCRIBE_QUEUE', '32'))
+EXECUTOR = os.getenv('TRANSCRIBE_EXECUTOR', 'thread')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class _Job:
+    __slots__ = ('ready', 'on_position')
+
+    def __init__(self, ready, on_position):
+        self.ready = ready
+        self.on_position = on_position
+
+
+class TranscriptionPool:
+    def __init__(self, workers: int = WORKERS, queue_size: int = QUEUE_SIZE, executor: str = EXECUTOR):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.kind = executor
+        self._executor = None
+        self._running = 0
+        self._waiting = deque()
+        self._callbacks = set()
+        self.stats = {'started': 0, 'queued': 0, 'rejected': 0, 'failed': 0}
+
+    def full(self) -> bool:
+        return self._running >= self.workers and len(self._waiting) >= self.queue_size
+
+    def depth(self) -> int:
+        return len(self._waiting)
+
+    def admit(self) -> None:
+        """Raise QueueFull now if a new job would be refused."""
+        if self.full():
+            self.stats['rejected'] += 1
+            raise QueueFull(f'{len(self._waiting)} jobs are already waiting')
+
+    async def run(self, func, *args, on_position=None, admitted=False):
+        """Run func(*args) on a pool worker once one is free; QueueFull if the queue is full."""
+        if self._running < self.workers and not self._waiting:
+            self._running += 1
+        else:
+            if not admitted:
+                self.admit()
+            job = _Job(asyncio.get_running_loop().create_future(), on_position)
+            self._waiting.append(job)
+            self.stats['queued'] += 1
+            self._report(job, len(self._waiting))
+            try:
+                await job.ready
+            except asyncio.CancelledError:
+                if job in self._waiting:
+                    self._waiting.remove(job)
+                    self._report_positions()
+                elif not job.ready.cancelled():
+                    # _next() already gave us a worker: pass it on
+                    self._running -= 1
+                    self._next()
+                raise
+        self.stats['started'] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+        finally:
+            self._running -= 1
+            self._next()
+
+    def snapshot(self) -> dict:
+        return {**self.stats, 'running': self._running, 'waiting': len(self._waiting),
+                'workers': self.workers, 'executor': self.kind}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='transcribe')
+        return self._executor
+
+    def _next(self):
+        moved = False
+        while self._waiting and self._running < self.workers:
+            job = self._waiting.popleft()
+            moved = True
+            if job.ready.done():  # cancelled, its task has not run the cleanup yet
+                continue
+            self._running += 1
+            job.ready.set_result(None)
+        if moved:
+            self._report_positions()
+
+    def _report_positions(self):
+        for position, job in enumerate(self._waiting, 1):
+            self._report(job, position)
+
+    def _report(self, job, position):
+        if job.on_position is None:
+            return
+        task = asyncio.get_running_loop().create_task(self._call(job.on_position, position))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    @staticmethod
+    async def _call(callback, position):
+        try:
+            await callback(position)
+        except Exception:
+            pass  # feedback only, e.g. the message was already deleted
+
+
+pool = TranscriptionPool()
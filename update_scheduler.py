@@ -0,0 +1,93 @@
+"""Per-user ordering and bounded concurrency for incoming updates.
+
+UpdateScheduler is an outer middleware on dp.update. Updates from the same
+user (or chat, when there is no user) are handled one at a time in arrival
+order, so two quick taps cannot race on keyboard_input and friends; updates
+from different users run in parallel, at most UPDATE_CONCURRENCY at once.
+A user with more than UPDATE_QUEUE_PER_USER updates waiting gets the extra
+ones dropped.
+
+Payment queries skip both the lane and the concurrency limit: Telegram wants the
+pre-checkout answer within 10 seconds, and the same user's voice note may
+be transcribing in the lane for a minute.
+"""
+import asyncio
+import contextlib
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '64'))
+QUEUE_PER_USER = int(os.getenv('UPDATE_QUEUE_PER_USER', '20'))
+# Cheap, deadline-bound updates that must not wait behind long handlers
+BYPASS = ('pre_checkout_query', 'shipping_query')
+
+
+class _Lane:
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()  # FIFO, so updates keep their order
+        self.depth = 0
+
+
+class UpdateScheduler(BaseMiddleware):
+    def __init__(self, concurrency: int = CONCURRENCY, queue_per_user: int = QUEUE_PER_USER):
+        self.concurrency = concurrency
+        self.queue_per_user = queue_per_user
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lanes = {}  # user/chat id -> _Lane, only while it has updates
+        self._queued = 0
+        self._running = 0
+        self._stats = {'handled': 0, 'dropped': 0, 'bypassed': 0, 'max_depth': 0, 'max_queued': 0,
+                       'wait_total': 0.0, 'wait_max': 0.0}
+
+    async def __call__(self, handler, event: Update, data: dict):
+        if event.event_type in BYPASS:
+            self._stats['bypassed'] += 1
+            return await handler(event, data)
+        user = data.get('event_from_user')
+        chat = data.get('event_chat')
+        key = user.id if user else chat.id if chat else None
+        lane = None
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = _Lane()
+            if lane.depth >= self.queue_per_user:
+                self._stats['dropped'] += 1
+                return None
+            lane.depth += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], lane.depth)
+        self._queued += 1
+        self._stats['max_queued'] = max(self._stats['max_queued'], self._queued)
+        queued_at = time.monotonic()
+        started = False
+        try:
+            async with lane.lock if lane is not None else contextlib.nullcontext():
+                async with self._semaphore:
+                    started = True
+                    wait = time.monotonic() - queued_at
+                    self._queued -= 1
+                    self._running += 1
+                    self._stats['wait_total'] += wait
+                    self._stats['wait_max'] = max(self._stats['wait_max'], wait)
+                    try:
+                        return await handler(event, data)
+                    finally:
+                        self._running -= 1
+                        self._stats['handled'] += 1
+        finally:
+            if not started:
+                self._queued -= 1
+            if lane is not None:
+                lane.depth -= 1
+                if lane.depth == 0:
+                    del self._lanes[key]
+
+    def stats(self) -> dict:
+        handled = self._stats['handled']
+        return {**self._stats, 'queued': self._queued, 'running': self._running, 'users': len(self._lanes),
+                'wait_avg': self._stats['wait_total'] / handled if handled else 0.0}
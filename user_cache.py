@@ -0,0 +1,102 @@
+"""Bounded LRU + TTL cache of users rows (name, beta, voice_time, voice_counter).
+
+Shared by db.py and db_async.py. Writers invalidate the entry, readers
+fill it on a miss. A cached value of None means "no such user".
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+KNOWN_SIZE = int(os.getenv('KNOWN_USERS_SIZE', '100000'))
+RECENT_INVALIDATIONS = 10000
+
+MISS = object()
+
+_entries = OrderedDict()  # tg_id -> (expires_at, row)
+_known = OrderedDict()  # tg_ids that already have a users row (rows are never deleted)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+# Every invalidation gets the next sequence number, remembered per user, so
+# a reader that raced a writer of the same user does not put a stale row
+# back (see put()) while fills for other users still go through
+_version = 0
+_invalidated = OrderedDict()  # tg_id -> _version of its last invalidation, oldest first
+_forgotten = 0  # newest _version no longer in _invalidated: older fills are refused
+
+
+def get(tg_id: int):
+    """Return the cached row (dict or None) or MISS."""
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(tg_id)
+        if entry is None or entry[0] < now:
+            if entry is not None:
+                del _entries[tg_id]
+            _stats['misses'] += 1
+            return MISS
+        _entries.move_to_end(tg_id)
+        _stats['hits'] += 1
+        return entry[1]
+
+
+def version() -> int:
+    return _version
+
+
+def put(tg_id: int, row, seen_version: int = None) -> None:
+    with _lock:
+        if seen_version is not None and max(_invalidated.get(tg_id, 0), _forgotten) > seen_version:
+            return
+        _entries[tg_id] = (time.monotonic() + CACHE_TTL, row)
+        _entries.move_to_end(tg_id)
+        while len(_entries) > CACHE_SIZE:
+            _entries.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def invalidate(tg_id: int) -> None:
+    global _version, _forgotten
+    with _lock:
+        _version += 1
+        _invalidated[tg_id] = _version
+        _invalidated.move_to_end(tg_id)
+        while len(_invalidated) > RECENT_INVALIDATIONS:
+            _forgotten = _invalidated.popitem(last=False)[1]
+        if _entries.pop(tg_id, None) is not None:
+            _stats['invalidations'] += 1
+
+
+def is_known(tg_id: int) -> bool:
+    with _lock:
+        return tg_id in _known
+
+
+def mark_known(tg_id: int) -> None:
+    with _lock:
+        _known[tg_id] = None
+        _known.move_to_end(tg_id)
+        while len(_known) > KNOWN_SIZE:
+            _known.popitem(last=False)
+
+
+def clear() -> None:
+    global _version, _forgotten
+    with _lock:
+        _version += 1
+        _forgotten = _version
+        _invalidated.clear()
+        _entries.clear()
+
+
+def stats() -> dict:
+    with _lock:
+        total = _stats['hits'] + _stats['misses']
+        return {
+            **_stats,
+            'size': len(_entries),
+            'known': len(_known),
+            'hit_rate': _stats['hits'] / total if total else 0.0,
+        }
@@ -0,0 +1,194 @@
+"""Voice note download and decoding without temporary files.
+
+The OGG/Opus file is downloaded into a SpooledTemporaryFile (kept in memory
+up to VOICE_SPOOL_MAX_BYTES, only bigger files spill to an anonymous temp
+file), streamed through ffmpeg's stdin and read back from its stdout as
+16 kHz mono 16-bit PCM, which becomes a speech_recognition AudioData.
+
+transcribe() splits long audio at pauses (energy-based VAD over 30 ms
+frames) into chunks of at most VOICE_CHUNK_SECONDS, recognizes them in
+parallel on the transcription pool and joins the texts in order, reporting
+the growing prefix through on_partial as chunks finish. A note is admitted
+to the pool as one unit (QueueFull is raised before any chunk runs, never
+halfway through), and at most VOICE_PARALLEL_CHUNKS of its chunks are in
+the pool at once, so a long note neither fills the queue nor pushes
+everyone else far back.
+"""
+import asyncio
+import math
+import os
+import tempfile
+import warnings
+from array import array
+
+import speech_recognition as sr
+
+import transcription_pool
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    try:
+        import audioop
+    except ImportError:  # removed in Python 3.13
+        audioop = None
+
+SPOOL_MAX_BYTES = int(os.getenv('VOICE_SPOOL_MAX_BYTES', str(10 * 1024 * 1024)))
+FFMPEG = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+SAMPLE_RATE = 16000
+SAMPLE_WIDTH = 2
+CHUNK = 64 * 1024
+
+# Recognition backends get unreliable on long requests; keep chunks well under a minute
+CHUNK_SECONDS = float(os.getenv('VOICE_CHUNK_SECONDS', '25'))
+MIN_CHUNK_SECONDS = float(os.getenv('VOICE_MIN_CHUNK_SECONDS', '5'))
+PARALLEL_CHUNKS = int(os.getenv('VOICE_PARALLEL_CHUNKS', '3'))
+FRAME_MS = 30
+# A frame is silent below max(SILENCE_RMS, noise floor * SILENCE_FACTOR)
+SILENCE_RMS = int(os.getenv('VOICE_SILENCE_RMS', '300'))
+SILENCE_FACTOR = float(os.getenv('VOICE_SILENCE_FACTOR', '2'))
+
+
+async def download(bot, file):
+    """Download a Telegram file (file_id or File) into a spooled buffer positioned at the start."""
+    if isinstance(file, str):
+        file = await bot.get_file(file)
+    buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        await bot.download_file(file.file_path, destination=buffer)
+    except BaseException:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
+
+
+async def decode(source) -> sr.AudioData:
+    """Decode any ffmpeg-readable audio from a binary file object to PCM."""
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0',
+        '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', '1', '-ar', str(SAMPLE_RATE), 'pipe:1',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def feed():
+        try:
+            while chunk := source.read(CHUNK):
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg gave up early, its stderr says why
+        finally:
+            process.stdin.close()
+
+    try:
+        _, pcm, errors = await asyncio.gather(feed(), process.stdout.read(), process.stderr.read())
+        await process.wait()
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed: {errors.decode(errors="replace").strip()}')
+    return sr.AudioData(pcm, SAMPLE_RATE, SAMPLE_WIDTH)
+
+
+async def load(bot, file) -> sr.AudioData:
+    """Download a voice note (file_id or File) and return it as recognizer-ready audio."""
+    buffer = await download(bot, file)
+    try:
+        return await decode(buffer)
+    finally:
+        buffer.close()
+
+
+def _rms(frame: bytes, width: int) -> int:
+    if audioop is not None:
+        return audioop.rms(frame, width)
+    samples = array('h', frame)  # the fallback only handles 16-bit PCM, which is what decode() makes
+    return int(math.sqrt(sum(x * x for x in samples) / len(samples))) if samples else 0
+
+
+def split(audio: sr.AudioData, max_seconds: float = CHUNK_SECONDS,
+          min_seconds: float = MIN_CHUNK_SECONDS) -> list:
+    """Cut audio into chunks of at most max_seconds, preferably in the middle of a pause."""
+    width = audio.sample_width
+    frame_bytes = int(audio.sample_rate * FRAME_MS / 1000) * width
+    data = audio.frame_data
+    frames = math.ceil(len(data) / frame_bytes)
+    max_frames = max(int(max_seconds * 1000 / FRAME_MS), 1)
+    if frames <= max_frames:
+        return [audio]
+    min_frames = min(int(min_seconds * 1000 / FRAME_MS), max_frames - 1)
+    energy = [_rms(data[i * frame_bytes:(i + 1) * frame_bytes], width) for i in range(frames)]
+    floor = sorted(energy)[len(energy) // 10]
+    threshold = max(SILENCE_RMS, floor * SILENCE_FACTOR)
+
+    cuts = [0]
+    while frames - cuts[-1] > max_frames:
+        start, end = cuts[-1] + min_frames, cuts[-1] + max_frames
+        # Middle of the longest silent run in the window, else its quietest frame
+        best, best_len, run_start = None, 0, None
+        for i in range(start, end + 1):
+            if energy[i] < threshold:
+                if run_start is None:
+                    run_start = i
+                if i - run_start + 1 > best_len:
+                    best, best_len = (run_start + i + 1) // 2, i - run_start + 1
+            else:
+                run_start = None
+        if best is None:
+            best = min(range(start, end + 1), key=energy.__getitem__)
+        cuts.append(best)
+    cuts.append(frames)
+    return [sr.AudioData(data[a * frame_bytes:b * frame_bytes], audio.sample_rate, width)
+            for a, b in zip(cuts, cuts[1:])]
+
+
+async def transcribe(audio: sr.AudioData, recognize, language: str, on_position=None, on_partial=None) -> tuple:
+    """Recognize audio chunk by chunk on the transcription pool; raises UnknownValueError if nothing is heard.
+
+    recognize(chunk, language) runs in the pool and returns (text, engine).
+    Returns the joined text and the engine that made it ('a+b' if chunks
+    fell back to different engines). on_position gets the first chunk's
+    place in the queue, on_partial the text of the chunks finished so far
+    (in order) while later ones are still running.
+    """
+    # The whole note is accepted or refused here, before any chunk is recognized
+    transcription_pool.pool.admit()
+    chunks = split(audio)
+    texts = [None] * len(chunks)
+    engines = set()
+    shown = 0
+    slots = asyncio.Semaphore(max(PARALLEL_CHUNKS, 1))
+
+    async def one(index, chunk):
+        nonlocal shown
+        try:
+            async with slots:
+                texts[index], engine = await transcription_pool.pool.run(
+                    recognize, chunk, language, on_position=on_position if index == 0 else None, admitted=True)
+            engines.add(engine)
+        except sr.UnknownValueError:
+            texts[index] = ''  # a pause or noise, the other chunks may still have speech
+        ready = 0
+        while ready < len(texts) and texts[ready] is not None:
+            ready += 1
+        if on_partial is not None and shown < ready < len(texts):
+            shown = ready
+            partial = ' '.join(t for t in texts[:ready] if t)
+            if partial:
+                try:
+                    await on_partial(partial)
+                except Exception:
+                    pass  # progress only
+
+    tasks = [asyncio.create_task(one(i, chunk)) for i, chunk in enumerate(chunks)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    text = ' '.join(t for t in texts if t)
+    if not text:
+        raise sr.UnknownValueError()
+    return text, '+'.join(sorted(engines))
@@ -0,0 +1,80 @@
+"""Webhook mode for bot.py: updates arrive over HTTP instead of long polling.
+
+    python bot.py --webhook        (or BOT_MODE=webhook)
+
+An aiohttp server on WEBHOOK_HOST:WEBHOOK_PORT accepts Telegram's POSTs
+on WEBHOOK_PATH, checks the X-Telegram-Bot-Api-Secret-Token header
+against WEBHOOK_SECRET, answers 200 at once and handles the update in a
+background task. The webhook is registered as WEBHOOK_URL + WEBHOOK_PATH
+on startup.
+
+    GET /healthz  200 while the process serves requests
+    GET /readyz   200 once the webhook is registered, 503 before that and
+                  while shutting down; the body has the scheduler stats
+
+fake_telegram.py drives this locally without Telegram.
+"""
+import asyncio
+import json
+import os
+import secrets
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+URL = os.getenv('WEBHOOK_URL')
+# Telegram accepts 1-256 characters of A-Z, a-z, 0-9, _ and -
+SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+
+def build_app(bot: Bot, dp: Dispatcher, stats=None) -> web.Application:
+    state = {'ready': False}
+
+    async def healthz(request: web.Request):
+        return web.Response(text='ok')
+
+    async def readyz(request: web.Request):
+        body = {'ready': state['ready'], **(stats() if stats else {})}
+        return web.Response(text=json.dumps(body, default=str), content_type='application/json',
+                            status=200 if state['ready'] else 503)
+
+    async def on_startup(app: web.Application):
+        if URL:
+            await bot.set_webhook(URL.rstrip('/') + PATH, secret_token=SECRET,
+                                  allowed_updates=dp.resolve_used_update_types())
+        state['ready'] = True
+        print(f'Webhook is live on {HOST}:{PORT}{PATH}')
+
+    async def on_shutdown(app: web.Application):
+        # Stop taking traffic first; the webhook stays registered for the next instance
+        state['ready'] = False
+
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    app.router.add_get('/readyz', readyz)
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=SECRET,
+                         handle_in_background=True).register(app, path=PATH)
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def serve(bot: Bot, dp: Dispatcher, stats=None) -> None:
+    """Run the webhook server until cancelled."""
+    if not URL:
+        print('WEBHOOK_URL is not set, the webhook is not registered with Telegram')
+    runner = web.AppRunner(build_app(bot, dp, stats))
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, HOST, PORT).start()
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()